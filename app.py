@@ -1,30 +1,979 @@
-import re
+from flask import Flask, Request, Response, render_template, request, redirect, url_for, jsonify, send_file, send_from_directory, abort
+from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy import text, func
+from datetime import datetime
+import os
+import json
+import uuid
+import yt_dlp
+from werkzeug.utils import secure_filename
+from PIL import Image
+from io import BytesIO
+import numpy as np
+from jobs import JobQueue
+from store import ContentStore, IngestFile, ContentRejected, hash_file
+from resumable import UploadSessions, UploadError, UploadRejected
+from container import SNIFF_SIZE, needs_faststart
+from probe import validate_video, is_video_header
+from transcode import remove_hls
+from remux import RemuxCache, can_remux
+from youtube import (VideoInfoCache, extract_video_id, fetch_first_available, oembed_info,
+                     THUMBNAIL_NAMES, YOUTUBE_IMAGE_HOST, YOUTUBE_OEMBED_URL)
+import http_client
+from thumbnails import write_thumbnail_set, default_variant, negotiate_format, MIMETYPES
 
+class UploadRequest(Request):
+    """Streams multipart file fields straight into the upload store.
 
-def extract_youtube_thumbnail(youtube_url):
-    # Extract the video ID using regex
-    video_id_match = re.search(r'(?:https?://)?(?:www\.)?(?:youtube\.com/(?:[^/\n]+/\S+/|(?:v|e(?:mbed)?|vi|watch|shorts)/|.*[?&]v=)|youtu\.be/)([a-zA-Z0-9_-]{11})', youtube_url)
-    if not video_id_match:
+    Werkzeug would otherwise spool each file to a temporary file that
+    upload_video then copies. Here the spool file is an IngestFile in the
+    store's tmp folder: it is hashed and its magic bytes are checked as
+    the body arrives, and put_file() just renames it into place.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.ingest_files = []
+
+    def _get_file_stream(self, total_content_length, content_type, filename=None, content_length=None):
+        extension = filename.rsplit('.', 1)[-1].lower() if filename and '.' in filename else ''
+        stream = IngestFile(upload_store.temp_path(f'.{extension}'), is_video_header, SNIFF_SIZE)
+        self.ingest_files.append(stream)
+        return stream
+
+    def close(self):
+        super().close()
+        # Also covers bodies that were rejected or cut off mid-parse
+        for stream in self.ingest_files:
+            stream.close()
+
+app = Flask(__name__)
+app.request_class = UploadRequest
+app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///database.db'
+app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+app.config['UPLOAD_FOLDER'] = 'uploads'
+app.config['THUMBNAIL_FOLDER'] = 'thumbnails'
+# Bounds a single request: the plain form upload or one chunk. Chunked
+# uploads (see resumable.py) are only limited by UPLOAD_MAX_SIZE
+app.config['MAX_CONTENT_LENGTH'] = 500 * 1024 * 1024
+app.config['UPLOAD_MAX_SIZE'] = int(os.environ.get('UPLOAD_MAX_SIZE', 0))  # bytes, 0 = unlimited
+app.config['UPLOAD_CHUNK_SIZE'] = int(os.environ.get('UPLOAD_CHUNK_SIZE', 8 * 1024 * 1024))
+app.config['UPLOAD_EXPIRY'] = int(os.environ.get('UPLOAD_EXPIRY', 86400))  # seconds without a chunk before an upload is dropped
+app.config['ALLOWED_EXTENSIONS'] = {'mp4', 'avi', 'mov', 'mkv', 'webm', 'flv'}
+app.config['JOB_MAX_ATTEMPTS'] = int(os.environ.get('JOB_MAX_ATTEMPTS', 3))
+app.config['JOB_RETRY_DELAY'] = int(os.environ.get('JOB_RETRY_DELAY', 30))  # seconds, doubled per attempt
+app.config['THUMBNAIL_WORKERS'] = int(os.environ.get('THUMBNAIL_WORKERS', os.cpu_count() or 1))
+app.config['THUMBNAIL_MAX_IN_FLIGHT'] = int(os.environ.get('THUMBNAIL_MAX_IN_FLIGHT', app.config['THUMBNAIL_WORKERS']))
+app.config['THUMBNAIL_MAX_QUEUED'] = int(os.environ.get('THUMBNAIL_MAX_QUEUED', 2 * app.config['THUMBNAIL_MAX_IN_FLIGHT']))
+app.config['THUMBNAIL_SEEK_MODE'] = os.environ.get('THUMBNAIL_SEEK_MODE', 'keyframe')  # keyframe, accurate or cv2
+app.config['THUMBNAIL_SEEK_SECONDS'] = float(os.environ.get('THUMBNAIL_SEEK_SECONDS', 1.0))
+# Frames scored per video when picking the thumbnail (1 = always use THUMBNAIL_SEEK_SECONDS)
+app.config['THUMBNAIL_SAMPLES'] = int(os.environ.get('THUMBNAIL_SAMPLES', 8))
+app.config['THUMBNAIL_BUDGET_SECONDS'] = float(os.environ.get('THUMBNAIL_BUDGET_SECONDS', 5.0))
+app.config['THUMBNAIL_WIDTHS'] = tuple(int(w) for w in os.environ.get('THUMBNAIL_WIDTHS', '320,640,1280').split(','))
+app.config['THUMBNAIL_FORMATS'] = os.environ.get('THUMBNAIL_FORMATS', 'avif,webp,jpeg').split(',')
+# Pillow save() options per format; see thumbnails.DEFAULT_ENCODERS
+app.config['THUMBNAIL_ENCODERS'] = {
+    fmt: options for fmt, options in {
+        'avif': {'quality': int(os.environ.get('THUMBNAIL_AVIF_QUALITY', 60)),
+                 'speed': int(os.environ.get('THUMBNAIL_AVIF_SPEED', 6))},
+        'webp': {'quality': int(os.environ.get('THUMBNAIL_WEBP_QUALITY', 80)),
+                 'method': int(os.environ.get('THUMBNAIL_WEBP_METHOD', 4))},
+        'jpeg': {'quality': int(os.environ.get('THUMBNAIL_JPEG_QUALITY', 82)),
+                 'optimize': True, 'progressive': True},
+    }.items() if fmt in app.config['THUMBNAIL_FORMATS'] or fmt == 'jpeg'
+}
+# Hover-scrub sprite sheets: one tile every SPRITE_INTERVAL seconds, capped at SPRITE_MAX_FRAMES
+app.config['SPRITE_INTERVAL'] = float(os.environ.get('SPRITE_INTERVAL', 10))
+app.config['SPRITE_TILE_WIDTH'] = int(os.environ.get('SPRITE_TILE_WIDTH', 160))
+app.config['SPRITE_COLUMNS'] = int(os.environ.get('SPRITE_COLUMNS', 10))
+app.config['SPRITE_MAX_FRAMES'] = int(os.environ.get('SPRITE_MAX_FRAMES', 100))
+# Watch-folder ingestion (watcher.py): comma-separated directories whose
+# subdirectory names become categories
+app.config['WATCH_FOLDERS'] = [f for f in os.environ.get('WATCH_FOLDERS', '').split(',') if f]
+app.config['WATCH_DEFAULT_CATEGORY'] = os.environ.get('WATCH_DEFAULT_CATEGORY', 'Unsorted')
+app.config['WATCH_SETTLE_SECONDS'] = float(os.environ.get('WATCH_SETTLE_SECONDS', 10))
+app.config['WATCH_RESCAN_SECONDS'] = float(os.environ.get('WATCH_RESCAN_SECONDS', 300))
+app.config['WATCH_WORKERS'] = int(os.environ.get('WATCH_WORKERS', 2))
+# HLS ladder transcoding (transcode.py): libx264 on the CPU only, with
+# TRANSCODE_CONCURRENCY ffmpeg runs at a time in the worker
+app.config['TRANSCODE_ENABLED'] = os.environ.get('TRANSCODE_ENABLED', '1') == '1'
+app.config['TRANSCODE_CONCURRENCY'] = int(os.environ.get('TRANSCODE_CONCURRENCY', 1))
+app.config['TRANSCODE_THREADS'] = int(os.environ.get('TRANSCODE_THREADS', 0))  # per ffmpeg, 0 = auto
+app.config['TRANSCODE_PRESET'] = os.environ.get('TRANSCODE_PRESET', 'veryfast')
+app.config['HLS_HEIGHTS'] = tuple(int(h) for h in os.environ.get('HLS_HEIGHTS', '1080,720,480,360').split(','))
+app.config['HLS_SEGMENT_SECONDS'] = int(os.environ.get('HLS_SEGMENT_SECONDS', 6))
+# With TRANSCODE_SEGMENT_WORKERS > 1, videos longer than two chunks are
+# cut at keyframes and their chunks encoded by that many ffmpeg processes
+# at once. Off (1) by default: benchmark it on the host first
+# (benchmarks/segment_transcode.py)
+app.config['TRANSCODE_SEGMENT_WORKERS'] = int(os.environ.get('TRANSCODE_SEGMENT_WORKERS', 1))
+app.config['TRANSCODE_CHUNK_SECONDS'] = int(os.environ.get('TRANSCODE_CHUNK_SECONDS', 60))
+# Remux MP4/MOV uploads whose moov box trails the media data so they can
+# start playing before the whole file has downloaded
+app.config['FASTSTART_ENABLED'] = os.environ.get('FASTSTART_ENABLED', '1') == '1'
+app.config['FASTSTART_EXTENSIONS'] = {'mp4', 'mov'}
+# Containers browsers can't play that /stream/<id> rewraps into fragmented
+# MP4 on the fly (remux.py); finished remuxes are kept in an LRU cache
+app.config['REMUX_EXTENSIONS'] = {'mkv', 'avi', 'flv'}
+app.config['REMUX_CACHE_FOLDER'] = os.environ.get('REMUX_CACHE_FOLDER', os.path.join(app.instance_path, 'remux_cache'))
+app.config['REMUX_CACHE_MB'] = int(os.environ.get('REMUX_CACHE_MB', 1024))
+# yt-dlp lookups cached per video ID, in memory and in a shared SQLite file
+app.config['YOUTUBE_CACHE_TTL'] = int(os.environ.get('YOUTUBE_CACHE_TTL', 7 * 86400))
+app.config['YOUTUBE_CACHE_SIZE'] = int(os.environ.get('YOUTUBE_CACHE_SIZE', 1024))
+# Title and thumbnails come from oEmbed and the image host directly; yt-dlp
+# is only the fallback. Point these at a stand-in server for testing
+app.config['YOUTUBE_OEMBED_URL'] = os.environ.get('YOUTUBE_OEMBED_URL', YOUTUBE_OEMBED_URL)
+app.config['YOUTUBE_IMAGE_HOST'] = os.environ.get('YOUTUBE_IMAGE_HOST', YOUTUBE_IMAGE_HOST).rstrip('/')
+# Playlist/channel imports (playlist_import.py): thumbnails fetched this
+# many at a time, new rows committed this many per transaction
+app.config['YOUTUBE_IMPORT_CONCURRENCY'] = int(os.environ.get('YOUTUBE_IMPORT_CONCURRENCY', 16))
+app.config['YOUTUBE_IMPORT_BATCH_SIZE'] = int(os.environ.get('YOUTUBE_IMPORT_BATCH_SIZE', 50))
+# Imports running at once per worker, on threads of their own
+app.config['YOUTUBE_IMPORT_JOBS'] = int(os.environ.get('YOUTUBE_IMPORT_JOBS', 2))
+# Connections the shared HTTP client keeps per host; enough by default for
+# an import probing every thumbnail candidate of its videos at once
+app.config['HTTP_POOL_SIZE'] = int(os.environ.get(
+    'HTTP_POOL_SIZE', app.config['YOUTUBE_IMPORT_CONCURRENCY'] * len(THUMBNAIL_NAMES)
+))
+app.config['THUMBNAIL_METRICS_FILE'] = os.path.join(app.instance_path, 'thumbnail_metrics.json')
+
+db = SQLAlchemy(app)
+
+# Ensure upload and thumbnail directories exist
+os.makedirs(app.config['UPLOAD_FOLDER'], exist_ok=True)
+os.makedirs(app.config['THUMBNAIL_FOLDER'], exist_ok=True)
+
+# Uploads and generated images are content-addressed (see store.py)
+upload_store = ContentStore(app.config['UPLOAD_FOLDER'], os.path.join(app.instance_path, 'upload_store.db'))
+thumbnail_store = ContentStore(app.config['THUMBNAIL_FOLDER'], os.path.join(app.instance_path, 'thumbnail_store.db'))
+remux_cache = RemuxCache(app.config['REMUX_CACHE_FOLDER'], app.config['REMUX_CACHE_MB'] * 1024 * 1024)
+http_client.client.set_pool_size(app.config['HTTP_POOL_SIZE'])
+youtube_cache = VideoInfoCache(
+    os.path.join(app.instance_path, 'youtube_cache.db'),
+    ttl=app.config['YOUTUBE_CACHE_TTL'],
+    max_entries=app.config['YOUTUBE_CACHE_SIZE']
+)
+
+# Chunks are written straight into part files inside the upload store,
+# so finishing an upload is a rename rather than a copy
+upload_sessions = UploadSessions(
+    os.path.join(app.instance_path, 'uploads.db'),
+    upload_store.tmp_folder,
+    chunk_size=app.config['UPLOAD_CHUNK_SIZE'],
+    expiry=app.config['UPLOAD_EXPIRY'],
+    accept_header=is_video_header
+)
+
+# Background jobs live in their own SQLite file so the worker never
+# contends with web requests for the main database lock
+job_queue = JobQueue(
+    os.path.join(app.instance_path, 'jobs.db'),
+    max_attempts=app.config['JOB_MAX_ATTEMPTS'],
+    retry_delay=app.config['JOB_RETRY_DELAY']
+)
+
+# Database Models
+class Category(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    name = db.Column(db.String(100), nullable=False, unique=True)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    videos = db.relationship('Video', backref='category', lazy=True)
+
+class Video(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    title = db.Column(db.String(200), nullable=False)
+    thumbnail_path = db.Column(db.String(300), nullable=False, default='')
+    video_path = db.Column(db.String(300), index=True)  # For uploaded videos: an upload_store key
+    youtube_url = db.Column(db.String(300))  # For YouTube links
+    is_youtube = db.Column(db.Boolean, default=False)
+    category_id = db.Column(db.Integer, db.ForeignKey('category.id'), nullable=False)
+    upload_date = db.Column(db.DateTime, default=datetime.utcnow)
+    # 'pending' until the worker has generated the thumbnail, 'failed' once dead-lettered
+    status = db.Column(db.String(20), nullable=False, default='ready', server_default='ready', index=True)
+    sprite_path = db.Column(db.String(300))  # Hover-scrub sprite sheet (see sprites.py)
+    sprite_vtt_path = db.Column(db.String(300))  # WebVTT index into sprite_path
+    # Technical metadata from probe.probe_video(), filled in by the worker
+    duration = db.Column(db.Float, index=True)  # seconds
+    width = db.Column(db.Integer, index=True)
+    height = db.Column(db.Integer, index=True)
+    fps = db.Column(db.Float)
+    video_codec = db.Column(db.String(32), index=True)
+    audio_codec = db.Column(db.String(32))
+    bitrate = db.Column(db.Integer, index=True)  # bits per second
+    container = db.Column(db.String(64))
+    file_size = db.Column(db.BigInteger, index=True)  # bytes
+    hls_path = db.Column(db.String(300))  # HLS master playlist, relative to UPLOAD_FOLDER (see transcode.py)
+    variants = db.relationship('ThumbnailVariant', backref='video', lazy='selectin',
+                               order_by='ThumbnailVariant.width', cascade='all, delete-orphan')
+
+    def set_metadata(self, metadata):
+        """Copy the fields of a probe.probe_video() result"""
+        for field in ('duration', 'width', 'height', 'fps', 'video_codec', 'audio_codec',
+                      'bitrate', 'container', 'file_size'):
+            setattr(self, field, metadata.get(field))
+
+    def set_thumbnails(self, variants):
+        """Attach a thumbnail set from write_thumbnail_set()"""
+        self.variants = [ThumbnailVariant(**variant) for variant in variants]
+        self.thumbnail_path = default_variant(variants)['path']
+
+    def share_thumbnails(self, source):
+        """Reuse the metadata and generated images of a video with the same content.
+
+        The caller takes thumbnail_store references for the shared keys.
+        """
+        for field in ('duration', 'width', 'height', 'fps', 'video_codec', 'audio_codec',
+                      'bitrate', 'container', 'file_size', 'thumbnail_path', 'sprite_path', 'sprite_vtt_path',
+                      'hls_path'):
+            setattr(self, field, getattr(source, field))
+        self.variants = [
+            ThumbnailVariant(width=v.width, height=v.height, format=v.format, path=v.path)
+            for v in source.variants
+        ]
+        self.status = 'ready'
+
+    def _variant_url(self, width):
+        # The JPEG's content hash versions the URL, so a negotiated
+        # thumbnail can be cached as immutably as the files themselves
+        jpeg = next((v for v in self.variants if v.width == width and v.format == 'jpeg'), None)
+        digest = ContentStore.digest_of(jpeg.path) if jpeg else None
+        return url_for('video_thumbnail', video_id=self.id, width=width, v=digest[:12] if digest else None)
+
+    def thumbnail_url(self):
+        if not self.variants:
+            return url_for('thumbnail_file', filename=self.thumbnail_path)
+        width = next(v.width for v in self.variants if v.path == self.thumbnail_path)
+        return self._variant_url(width)
+
+    def srcset(self):
+        widths = sorted({v.width for v in self.variants})
+        return ', '.join(f'{self._variant_url(width)} {width}w' for width in widths)
+
+    def media_url(self):
+        return url_for('media_file', filename=self.video_path)
+
+    def remuxable(self):
+        """An upload in a container browsers can't play, holding codecs they can"""
+        return (not self.is_youtube and bool(self.video_path) and can_remux(self.video_codec)
+                and self.video_path.rsplit('.', 1)[-1] in app.config['REMUX_EXTENSIONS'])
+
+    def playback_url(self):
+        """The raw file, or its fragmented-MP4 remux for MKV/AVI/FLV"""
+        return url_for('stream_video', video_id=self.id) if self.remuxable() else self.media_url()
+
+    def remux_name(self):
+        # Named after the content, so videos sharing an upload share the remux
+        return f'{ContentStore.digest_of(self.video_path) or secure_filename(self.video_path)}.mp4'
+
+    def hls_url(self):
+        return url_for('media_file', filename=self.hls_path) if self.hls_path else None
+
+    def stored_thumbnail_keys(self):
+        """Every thumbnail store key this video holds a reference to"""
+        keys = {variant.path for variant in self.variants}
+        for key in (self.thumbnail_path, self.sprite_path, self.sprite_vtt_path):
+            if key:
+                keys.add(key)
+        return keys
+
+class ThumbnailVariant(db.Model):
+    """One resized rendition of a video's thumbnail, produced from a single decode"""
+    id = db.Column(db.Integer, primary_key=True)
+    video_id = db.Column(db.Integer, db.ForeignKey('video.id'), nullable=False, index=True)
+    width = db.Column(db.Integer, nullable=False)
+    height = db.Column(db.Integer, nullable=False)
+    format = db.Column(db.String(10), nullable=False, default='jpeg')
+    path = db.Column(db.String(300), nullable=False)
+
+class UploadBatch(db.Model):
+    """A multi-file upload whose per-file progress can be polled at /batches/<id>"""
+    id = db.Column(db.String(32), primary_key=True, default=lambda: uuid.uuid4().hex)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    items = db.relationship('UploadBatchItem', backref='batch', lazy='selectin',
+                            order_by='UploadBatchItem.id', cascade='all, delete-orphan')
+
+    def summary(self):
+        items = [item.summary() for item in self.items]
+        counts = {}
+        for item in items:
+            counts[item['status']] = counts.get(item['status'], 0) + 1
+        return {
+            'id': self.id,
+            'files': len(items),
+            'counts': counts,
+            'done': 'pending' not in counts,
+            'items': items,
+        }
+
+class UploadBatchItem(db.Model):
+    """One file of an UploadBatch: the Video it became, or why it was rejected"""
+    id = db.Column(db.Integer, primary_key=True)
+    batch_id = db.Column(db.String(32), db.ForeignKey('upload_batch.id'), nullable=False, index=True)
+    filename = db.Column(db.String(300), nullable=False)
+    video_id = db.Column(db.Integer, db.ForeignKey('video.id'))
+    error = db.Column(db.String(300))
+    video = db.relationship('Video')
+
+    def summary(self):
+        if self.error:
+            status = 'rejected'
+        elif self.video is None:
+            status = 'deleted'
+        else:
+            status = self.video.status
+        return {'filename': self.filename, 'video_id': self.video_id, 'status': status, 'error': self.error}
+
+class YoutubeImport(db.Model):
+    """A YouTube playlist or channel import whose progress can be polled at /imports/<id>"""
+    id = db.Column(db.String(32), primary_key=True, default=lambda: uuid.uuid4().hex)
+    source_url = db.Column(db.String(500), nullable=False)
+    category_id = db.Column(db.Integer, db.ForeignKey('category.id'), nullable=False)
+    # 'pending' until the playlist is expanded into items, then 'importing', 'done' or 'failed'
+    status = db.Column(db.String(20), nullable=False, default='pending', index=True)
+    error = db.Column(db.String(300))
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+    def summary(self):
+        counts = dict(
+            db.session.query(YoutubeImportItem.status, func.count(YoutubeImportItem.id))
+            .filter_by(import_id=self.id).group_by(YoutubeImportItem.status)
+        )
+        failed = YoutubeImportItem.query.filter_by(import_id=self.id, status='failed') \
+            .order_by(YoutubeImportItem.position).limit(100)
+        return {
+            'id': self.id,
+            'url': self.source_url,
+            'status': self.status,
+            'error': self.error,
+            'videos': sum(counts.values()),
+            'counts': counts,
+            'done': self.status in ('done', 'failed'),
+            'failed': [{'youtube_id': item.youtube_id, 'title': item.title, 'error': item.error} for item in failed],
+        }
+
+class YoutubeImportItem(db.Model):
+    """One video of a YoutubeImport: 'pending', 'done', 'skipped' or 'failed'"""
+    id = db.Column(db.Integer, primary_key=True)
+    import_id = db.Column(db.String(32), db.ForeignKey('youtube_import.id'), nullable=False, index=True)
+    position = db.Column(db.Integer, nullable=False)
+    youtube_id = db.Column(db.String(11), nullable=False)
+    title = db.Column(db.String(200))
+    duration = db.Column(db.Float)
+    status = db.Column(db.String(20), nullable=False, default='pending', index=True)
+    video_id = db.Column(db.Integer, db.ForeignKey('video.id'))
+    error = db.Column(db.String(300))
+    __table_args__ = (db.UniqueConstraint('import_id', 'youtube_id'),)
+
+def add_missing_columns():
+    """Add model columns that are missing from tables created by an older version"""
+    inspector = db.inspect(db.engine)
+    for table in db.metadata.sorted_tables:
+        existing = {column['name'] for column in inspector.get_columns(table.name)}
+        for column in table.columns:
+            if column.name in existing:
+                continue
+            ddl = f'ALTER TABLE {table.name} ADD COLUMN {column.name} {column.type.compile(db.engine.dialect)}'
+            if column.server_default is not None:
+                ddl += f" DEFAULT '{column.server_default.arg}'"
+            db.session.execute(text(ddl))
+        db.session.commit()
+        for index in table.indexes:
+            index.create(db.engine, checkfirst=True)
+
+# Initialize database
+with app.app_context():
+    db.create_all()
+    add_missing_columns()
+
+@app.template_filter('duration')
+def format_duration(seconds):
+    """Render seconds as H:MM:SS or M:SS for duration badges"""
+    if seconds is None:
+        return ''
+    minutes, seconds = divmod(int(round(seconds)), 60)
+    hours, minutes = divmod(minutes, 60)
+    if hours:
+        return f'{hours}:{minutes:02d}:{seconds:02d}'
+    return f'{minutes}:{seconds:02d}'
+
+def allowed_file(filename):
+    return '.' in filename and filename.rsplit('.', 1)[1].lower() in app.config['ALLOWED_EXTENSIONS']
+
+def title_from_filename(filename):
+    """Default title for a file uploaded without one: its name, minus folders and extension"""
+    return os.path.splitext(os.path.basename(filename or ''))[0] or 'Untitled Video'
+
+def add_batch_item(batch_id, filename, video=None, error=None):
+    """Record the outcome of one file of a batch upload (no-op outside a batch)"""
+    if not batch_id:
+        return
+    db.session.add(UploadBatchItem(
+        batch_id=batch_id, filename=filename, video_id=video.id if video else None, error=error
+    ))
+    db.session.commit()
+
+def create_uploaded_video(video_path, extension, title, category_id, digest=None):
+    """Validate a received file, move it into the upload store and queue its thumbnail.
+
+    Pass the SHA-256 `digest` if it was computed while receiving the file
+    so it isn't read again. Returns the new Video, or None if the file is
+    not a readable video (it is removed).
+    """
+    if not validate_video(video_path):
+        print(f"Rejected upload {title}: not a readable video")
+        os.remove(video_path)
         return None
-    video_id = video_id_match.group(1)
+    
+    digest = digest or hash_file(video_path)
+    # Also finds bytes stored in rewritten form, e.g. an upload the worker
+    # has already remuxed for faststart
+    video_key = upload_store.claim(digest)
+    if video_key is not None:
+        os.remove(video_path)
+        return create_video_for_key(video_key, title, category_id)
+    
+    video_key = upload_store.put_file(video_path, extension, digest)
+    if not (app.config['FASTSTART_ENABLED'] and extension in app.config['FASTSTART_EXTENSIONS']
+            and needs_faststart(upload_store.path(video_key))):
+        return create_video_for_key(video_key, title, category_id)
+    
+    # The remux is a full copy of the file, so it is left to the worker
+    # (process_faststart_job). It moves the video to the new key and only
+    # then queues the thumbnail, so nothing decodes a file being replaced
+    new_video = create_video_for_key(video_key, title, category_id, queue_thumbnail=False)
+    job_queue.enqueue('faststart', {'video_key': video_key, 'queue_thumbnails': True})
+    return new_video
+
+def create_video_for_key(video_key, title, category_id, queue_thumbnail=True):
+    """Add a Video for an upload_store key the caller holds a new reference to"""
+    new_video = Video(
+        title=title,
+        video_path=video_key,
+        is_youtube=False,
+        category_id=category_id,
+        status='pending'
+    )
+    
+    # The same bytes already uploaded (e.g. into another category) share
+    # one stored file; reuse its thumbnails too instead of decoding again
+    existing = Video.query.filter_by(video_path=video_key, status='ready').first()
+    if existing is not None:
+        new_video.share_thumbnails(existing)
+        for key in new_video.stored_thumbnail_keys():
+            thumbnail_store.add_ref(key)
+    
+    db.session.add(new_video)
+    db.session.commit()
+    if existing is None:
+        # Thumbnail is generated by the worker (see worker.py), which
+        # then queues the sprite sheet and transcode
+        if queue_thumbnail:
+            job_queue.enqueue('thumbnail', {'video_id': new_video.id})
+    else:
+        if not new_video.sprite_path:
+            job_queue.enqueue('sprite', {'video_id': new_video.id})
+        if not new_video.hls_path and app.config['TRANSCODE_ENABLED']:
+            job_queue.enqueue('transcode', {'video_id': new_video.id})
+    return new_video
 
-    # Define possible thumbnail URLs
-    thumbnail_urls = [
-        f'https://img.youtube.com/vi/{video_id}/maxresdefault.jpg',
-        f'https://img.youtube.com/vi/{video_id}/sddefault.jpg',
-        f'https://img.youtube.com/vi/{video_id}/hqdefault.jpg'
-    ]
+def youtube_video_info(youtube_url, fast=True):
+    """Title, thumbnail URLs (best first) and duration of a YouTube video.
 
-    # Attempt to download the thumbnail from each URL
-    for url in thumbnail_urls:
+    Looked up in youtube_cache by video ID first, then with a single
+    oEmbed request. yt-dlp, which takes seconds and gets rate-limited,
+    only runs when both miss, or with fast=False.
+    """
+    video_id = extract_video_id(youtube_url)
+    info = None
+    if fast and video_id:
+        info = youtube_cache.get(video_id)
+        if info is not None:
+            return info
         try:
-            response = requests.get(url)
-            if response.status_code == 200:
-                # Save the thumbnail
-                with open(f'{video_id}.jpg', 'wb') as f:
-                    f.write(response.content)
-                return 'YouTube Video'
+            info = oembed_info(video_id, app.config['YOUTUBE_OEMBED_URL'], app.config['YOUTUBE_IMAGE_HOST'])
         except Exception as e:
-            print(f'Error downloading thumbnail from {url}: {e}')  # Log the error
+            print(f"Error fetching oEmbed for {video_id}: {e}")
+    if info is None:
+        info = ytdlp_video_info(youtube_url)
+    if video_id:
+        youtube_cache.put(video_id, info)
+    return info
+
+def ytdlp_video_info(youtube_url):
+    ydl_opts = {
+        'quiet': True,
+        'no_warnings': True,
+        'extract_flat': True,
+    }
+    with yt_dlp.YoutubeDL(ydl_opts) as ydl:
+        extracted = ydl.extract_info(youtube_url, download=False)
+    
+    thumbnails = [extracted['thumbnail']] if extracted.get('thumbnail') else []
+    # yt-dlp lists thumbnails worst first; keep a few fallbacks
+    for thumbnail in reversed(extracted.get('thumbnails') or []):
+        if thumbnail.get('url') and thumbnail['url'] not in thumbnails and len(thumbnails) < 5:
+            thumbnails.append(thumbnail['url'])
+    return {
+        'title': extracted.get('title', 'YouTube Video'),
+        'thumbnails': thumbnails,
+        'duration': extracted.get('duration'),
+    }
+
+def download_image(urls):
+    """The best of `urls` that exists, as an RGB PIL image, or None.
+
+    The candidates are probed concurrently and only the winner is
+    downloaded (youtube.fetch_first_available).
+    """
+    try:
+        content = fetch_first_available(urls)
+    except Exception as e:
+        print(f"Error downloading thumbnail: {e}")
+        return None
+    return Image.open(BytesIO(content)).convert('RGB') if content else None
+
+def extract_youtube_thumbnail(youtube_url):
+    """Extract thumbnail from YouTube URL; returns (variants, title, duration)"""
+    try:
+        info = youtube_video_info(youtube_url)
+        
+        # Download the best thumbnail that is still there
+        img = download_image(info['thumbnails'])
+        if img is None:
+            # The direct image URLs failed; yt-dlp knows the real ones
+            info = youtube_video_info(youtube_url, fast=False)
+            img = download_image(info['thumbnails'])
+        if img is None:
+            raise ValueError('no thumbnail could be downloaded')
+        
+        # Save the same size set as uploaded videos (OpenCV wants BGR)
+        frame = np.asarray(img)[:, :, ::-1]
+        variants = write_thumbnail_set(
+            frame, thumbnail_store,
+            app.config['THUMBNAIL_WIDTHS'], app.config['THUMBNAIL_ENCODERS']
+        )
+        
+        return variants, info['title'], info['duration']
+    except Exception as e:
+        print(f"Error extracting YouTube thumbnail: {e}")
+        return None, None, None
+
+@app.route('/')
+def index():
+    categories = Category.query.all()
+    
+    # Get videos grouped by category
+    videos_by_category = {}
+    for category in categories:
+        videos_by_category[category.name] = Video.query.filter_by(category_id=category.id).all()
+    
+    return render_template('index.html', categories=categories, videos_by_category=videos_by_category)
+
+@app.route('/calendar')
+def calendar():
+    videos = Video.query.order_by(Video.upload_date.desc()).all()
+    
+    # Group videos by date
+    videos_by_date = {}
+    for video in videos:
+        date_key = video.upload_date.strftime('%Y-%m-%d')
+        if date_key not in videos_by_date:
+            videos_by_date[date_key] = []
+        videos_by_date[date_key].append(video)
+    
+    return render_template('calendar.html', videos_by_date=videos_by_date)
+
+@app.route('/add_category', methods=['POST'])
+def add_category():
+    category_name = request.form.get('category_name')
+    
+    if category_name:
+        existing = Category.query.filter_by(name=category_name).first()
+        if not existing:
+            new_category = Category(name=category_name)
+            db.session.add(new_category)
+            db.session.commit()
+    
+    return redirect(url_for('index'))
+
+@app.route('/add_youtube', methods=['POST'])
+def add_youtube():
+    youtube_url = request.form.get('youtube_url')
+    category_id = request.form.get('category_id')
+    
+    if youtube_url and category_id:
+        variants, video_title, duration = extract_youtube_thumbnail(youtube_url)
+        
+        if variants:
+            new_video = Video(
+                title=video_title,
+                youtube_url=youtube_url,
+                is_youtube=True,
+                category_id=category_id,
+                duration=duration
+            )
+            new_video.set_thumbnails(variants)
+            db.session.add(new_video)
+            db.session.commit()
+    
+    return redirect(url_for('index'))
+
+@app.route('/upload_video', methods=['POST'])
+def upload_video():
+    # Parsing the form is what receives the files, one after another (see
+    # UploadRequest); each is only validated and queued here, so probing
+    # and thumbnailing fan out to the worker
+    files = [file for file in request.files.getlist('video_file') if file]
+    category_id = request.form.get('category_id')
+    video_title = request.form.get('video_title')
+    
+    if not files or not category_id:
+        return redirect(url_for('index'))
+    
+    # Several files (or a folder) become a batch, titled by file name
+    batch = None
+    if len(files) > 1:
+        batch = UploadBatch()
+        db.session.add(batch)
+        db.session.commit()
+    batch_id = batch.id if batch else None
+    
+    for file in files:
+        filename = secure_filename(file.filename)
+        title = video_title if video_title and batch is None else title_from_filename(file.filename)
+        if not allowed_file(filename):
+            add_batch_item(batch_id, file.filename, error='unsupported file type')
+            continue
+        try:
+            digest = file.stream.finish()
+        except ContentRejected as e:
+            print(f"Rejected upload {filename}: {e}")
+            add_batch_item(batch_id, file.filename, error=str(e))
+            continue
+        video = create_uploaded_video(
+            file.stream.path, filename.rsplit('.', 1)[1].lower(), title, category_id, digest
+        )
+        add_batch_item(batch_id, file.filename, video, None if video else 'not a readable video')
+    
+    if batch is not None and request.accept_mimetypes.best == 'application/json':
+        return batch_status_response(batch, 202)
+    return redirect(url_for('index'))
+
+@app.route('/batches', methods=['POST'])
+def create_batch():
+    """Open a batch for a client that sends its files through the chunked upload API"""
+    batch = UploadBatch()
+    db.session.add(batch)
+    db.session.commit()
+    return batch_status_response(batch, 201)
+
+def batch_status_response(batch, status_code=200):
+    response = jsonify(batch.summary())
+    response.status_code = status_code
+    response.headers['Location'] = url_for('batch_status', batch_id=batch.id)
+    return response
+
+@app.route('/batches/<batch_id>')
+def batch_status(batch_id):
+    """Per-file status of a batch upload: pending, ready, failed, rejected or deleted"""
+    return batch_status_response(db.get_or_404(UploadBatch, batch_id))
+
+@app.route('/imports', methods=['POST'])
+def create_import():
+    """Queue the import of every video of a YouTube playlist or channel (see playlist_import.py)"""
+    data = request.get_json(silent=True) or request.form
+    source_url = data.get('url') or data.get('youtube_url')
+    category_id = data.get('category_id')
+    if not source_url or not category_id:
+        return jsonify({'error': 'url and category_id are required'}), 400
+    db.get_or_404(Category, category_id)
+    
+    # Asking again for an import that is still running just reports on it
+    youtube_import = YoutubeImport.query.filter(
+        YoutubeImport.source_url == source_url, YoutubeImport.category_id == category_id,
+        YoutubeImport.status.in_(('pending', 'importing'))
+    ).first()
+    if youtube_import is None:
+        youtube_import = YoutubeImport(source_url=source_url, category_id=category_id)
+        db.session.add(youtube_import)
+        db.session.commit()
+        job_queue.enqueue('youtube_import', {'import_id': youtube_import.id})
+    return import_status_response(youtube_import, 202)
+
+def import_status_response(youtube_import, status_code=200):
+    response = jsonify(youtube_import.summary())
+    response.status_code = status_code
+    response.headers['Location'] = url_for('import_status', import_id=youtube_import.id)
+    return response
+
+@app.route('/imports/<import_id>')
+def import_status(import_id):
+    """Progress of a playlist import: per-status video counts and the failures"""
+    return import_status_response(db.get_or_404(YoutubeImport, import_id))
+
+# Resumable chunked uploads: POST /uploads to start, PUT each chunk to
+# /uploads/<id>?offset=N (any order, in parallel), GET /uploads/<id> to
+# find what is missing after an interruption, then POST .../finalize
+def upload_status_response(upload, status_code=200):
+    response = jsonify({
+        'id': upload['id'],
+        'size': upload['size'],
+        'chunk_size': upload['chunk_size'],
+        'offset': upload['offset'],
+        'missing': upload['missing'],
+    })
+    response.status_code = status_code
+    response.headers['Upload-Offset'] = str(upload['offset'])
+    return response
+
+@app.route('/uploads', methods=['POST'])
+def create_upload():
+    data = request.get_json(silent=True) or request.form
+    filename = secure_filename(data.get('filename', ''))
+    category_id = data.get('category_id')
+    batch_id = data.get('batch_id')
+    if batch_id and db.session.get(UploadBatch, batch_id) is None:
+        return jsonify({'error': 'unknown batch'}), 404
+    try:
+        size = int(data.get('size'))
+    except (TypeError, ValueError):
+        size = -1
+    
+    if not allowed_file(filename) or not category_id or size <= 0:
+        return jsonify({'error': 'filename, size and category_id are required'}), 400
+    if app.config['UPLOAD_MAX_SIZE'] and size > app.config['UPLOAD_MAX_SIZE']:
+        return jsonify({'error': f"uploads are limited to {app.config['UPLOAD_MAX_SIZE']} bytes"}), 413
+    
+    upload = upload_sessions.create(
+        data.get('filename'), filename.rsplit('.', 1)[1].lower(), size,
+        title=data.get('video_title') or title_from_filename(data.get('filename')),
+        category_id=category_id,
+        batch_id=batch_id
+    )
+    response = upload_status_response(upload, 201)
+    response.headers['Location'] = url_for('upload_status', upload_id=upload['id'])
+    return response
+
+@app.route('/uploads/lookup', methods=['POST'])
+def lookup_upload():
+    """Pre-upload handshake: add the video straight away if its bytes are already stored.
+
+    The browser hashes the file first (static/js/hash-worker.js); a 404
+    means it has to be uploaded.
+    """
+    data = request.get_json(silent=True) or request.form
+    category_id = data.get('category_id')
+    if not data.get('sha256') or not category_id:
+        return jsonify({'error': 'sha256 and category_id are required'}), 400
+    
+    video_key = upload_store.claim(data['sha256'].lower())
+    if video_key is None:
+        return jsonify({'found': False}), 404
+    filename = data.get('filename')
+    video = create_video_for_key(video_key, data.get('video_title') or title_from_filename(filename), category_id)
+    add_batch_item(data.get('batch_id'), filename or video.title, video)
+    return jsonify({'found': True, 'video_id': video.id, 'status': video.status}), 201
+
+@app.route('/uploads/<upload_id>', methods=['GET', 'HEAD'])
+def upload_status(upload_id):
+    upload = upload_sessions.status(upload_id)
+    if upload is None:
+        abort(404)
+    return upload_status_response(upload)
+
+@app.route('/uploads/<upload_id>', methods=['PUT'])
+def upload_chunk(upload_id):
+    offset = request.args.get('offset', type=int)
+    if offset is None:
+        return jsonify({'error': 'offset is required'}), 400
+    try:
+        # request.stream is the raw body: nothing is spooled before it hits the part file
+        upload = upload_sessions.write_chunk(upload_id, offset, request.stream, request.content_length)
+    except KeyError:
+        abort(404)
+    except UploadRejected as e:
+        upload = upload_sessions.status(upload_id)
+        upload_sessions.abort(upload_id)
+        add_batch_item(upload['batch_id'], upload['filename'], error=str(e))
+        return jsonify({'error': str(e)}), 415
+    except UploadError as e:
+        return jsonify({'error': str(e)}), 409
+    return upload_status_response(upload)
+
+@app.route('/uploads/<upload_id>/finalize', methods=['POST'])
+def finalize_upload(upload_id):
+    try:
+        upload = upload_sessions.finish(upload_id)
+    except KeyError:
+        abort(404)
+    except UploadError as e:
+        return jsonify({'error': str(e)}), 409
+    
+    video = create_uploaded_video(
+        upload_sessions.part_path(upload_id), upload['extension'], upload['title'], upload['category_id']
+    )
+    add_batch_item(upload['batch_id'], upload['filename'], video, None if video else 'not a readable video')
+    if video is None:
+        return jsonify({'error': 'not a readable video'}), 422
+    return jsonify({'video_id': video.id, 'status': video.status}), 201
+
+@app.route('/uploads/<upload_id>', methods=['DELETE'])
+def cancel_upload(upload_id):
+    upload_sessions.abort(upload_id)
+    return '', 204
+
+@app.route('/get_categories')
+def get_categories():
+    categories = Category.query.all()
+    return jsonify([{'id': c.id, 'name': c.name} for c in categories])
+
+@app.route('/thumbnails/<path:filename>')
+def thumbnail_file(filename):
+    if ContentStore.digest_of(filename):
+        # Content-addressed: the name changes whenever the bytes do
+        response = send_from_directory(app.config['THUMBNAIL_FOLDER'], filename, max_age=31536000)
+        response.cache_control.immutable = True
+        return response
+    return send_from_directory(app.config['THUMBNAIL_FOLDER'], filename)
+
+# Served by the app so uploads work without a separate static mount
+MEDIA_MIMETYPES = {'.m3u8': 'application/vnd.apple.mpegurl', '.ts': 'video/mp2t'}
+
+@app.route('/media/<path:filename>')
+def media_file(filename):
+    immutable = ContentStore.digest_of(filename) is not None
+    response = send_from_directory(
+        app.config['UPLOAD_FOLDER'], filename, mimetype=MEDIA_MIMETYPES.get(os.path.splitext(filename)[1]),
+        max_age=31536000 if immutable else None
+    )
+    response.cache_control.immutable = immutable or None
+    return response
+
+@app.route('/stream/<int:video_id>')
+def stream_video(video_id):
+    """Play an MKV/AVI/FLV upload in the browser through a stream-copy remux to fragmented MP4"""
+    video = Video.query.get_or_404(video_id)
+    if not video.remuxable():
+        abort(404)
+    cached = remux_cache.get(video.remux_name())
+    if cached:
+        try:
+            return send_file(cached, mimetype='video/mp4', conditional=True)
+        except FileNotFoundError:
+            pass  # Evicted in between
+    # Live output has no length and can't serve ranges; seeking works once it is cached
+    return Response(
+        remux_cache.stream(upload_store.path(video.video_path), video.remux_name(), video.audio_codec),
+        mimetype='video/mp4', headers={'Cache-Control': 'no-store'}
+    )
+
+@app.route('/thumb/<int:video_id>/<int:width>')
+def video_thumbnail(video_id, width):
+    """Serve the best encoded variant of one thumbnail width for the client's Accept header"""
+    variants = ThumbnailVariant.query.filter_by(video_id=video_id, width=width).all()
+    if not variants:
+        abort(404)
+    by_format = {variant.format: variant for variant in variants}
+    fmt = negotiate_format(request.accept_mimetypes, by_format)
+    if fmt not in by_format:
+        fmt = next(iter(by_format))
+    versioned = 'v' in request.args
+    response = send_from_directory(
+        app.config['THUMBNAIL_FOLDER'], by_format[fmt].path, mimetype=MIMETYPES[fmt],
+        max_age=31536000 if versioned else None
+    )
+    response.cache_control.immutable = versioned or None
+    response.vary.add('Accept')
+    return response
+
+@app.route('/reports/capacity')
+def capacity_report():
+    """Storage and runtime totals for uploaded videos, computed in SQL"""
+    uploads = Video.query.filter(Video.is_youtube.is_(False))
+    totals = uploads.with_entities(
+        func.count(Video.id), func.sum(Video.file_size), func.sum(Video.duration),
+        func.count(Video.file_size)
+    ).one()
+
+    def breakdown(query, column):
+        rows = query.with_entities(
+            column, func.count(Video.id), func.sum(Video.file_size), func.sum(Video.duration)
+        ).group_by(column).order_by(func.sum(Video.file_size).desc()).all()
+        return [
+            {'key': key, 'videos': count, 'bytes': size or 0, 'seconds': round(duration or 0, 1)}
+            for key, count, size, duration in rows
+        ]
+
+    return jsonify({
+        'videos': totals[0],
+        'probed': totals[3],
+        'bytes': totals[1] or 0,
+        'seconds': round(totals[2] or 0, 1),
+        'by_category': breakdown(uploads.join(Category), Category.name),
+        'by_codec': breakdown(uploads, Video.video_codec),
+        'by_height': breakdown(uploads, Video.height),
+    })
+
+@app.cli.command('backfill-metadata')
+def backfill_metadata():
+    """Queue probe jobs for uploaded videos that have no technical metadata"""
+    videos = Video.query.filter(Video.is_youtube.is_(False), Video.file_size.is_(None)).all()
+    for video in videos:
+        job_queue.enqueue('probe', {'video_id': video.id})
+    print(f'Queued {len(videos)} probe jobs')
+
+@app.cli.command('backfill-hls')
+def backfill_hls():
+    """Queue transcode jobs for uploaded videos that have no HLS ladder yet"""
+    videos = Video.query.filter(Video.is_youtube.is_(False), Video.hls_path.is_(None), Video.status == 'ready').all()
+    for video in videos:
+        job_queue.enqueue('transcode', {'video_id': video.id})
+    print(f'Queued {len(videos)} transcode jobs')
+
+@app.cli.command('backfill-faststart')
+def backfill_faststart():
+    """Queue faststart remuxes for stored MP4/MOV uploads whose moov box comes last"""
+    keys = {
+        video.video_path for video in Video.query.filter(Video.is_youtube.is_(False), Video.status == 'ready')
+        if video.video_path and video.video_path.rsplit('.', 1)[-1] in app.config['FASTSTART_EXTENSIONS']
+    }
+    # Queued per stored file: every video sharing it moves to the new key together
+    keys = [key for key in keys if os.path.exists(upload_store.path(key)) and needs_faststart(upload_store.path(key))]
+    for key in keys:
+        job_queue.enqueue('faststart', {'video_key': key})
+    print(f'Queued {len(keys)} faststart jobs')
+
+@app.route('/jobs/status')
+def jobs_status():
+    engine_metrics = None
+    if os.path.exists(app.config['THUMBNAIL_METRICS_FILE']):
+        with open(app.config['THUMBNAIL_METRICS_FILE']) as f:
+            engine_metrics = json.load(f)
+    return jsonify({
+        'counts': job_queue.counts(),
+        'dead_letters': job_queue.dead_letters(),
+        'thumbnail_engine': engine_metrics
+    })
+
+@app.route('/delete_video/<int:video_id>', methods=['POST'])
+def delete_video(video_id):
+    video = Video.query.get_or_404(video_id)
+    
+    # Release stored files; each is only unlinked once no other video
+    # references the same content (pending videos have no thumbnails yet)
+    for key in video.stored_thumbnail_keys():
+        thumbnail_store.release(key)
+    
+    if not video.is_youtube and video.video_path:
+        if upload_store.release(video.video_path):
+            # Last reference to this content: its HLS ladder goes too
+            remove_hls(app.config['UPLOAD_FOLDER'], video.video_path)
+    
+    db.session.delete(video)
+    db.session.commit()
+    
+    return redirect(request.referrer or url_for('index'))
 
-    return None
+if __name__ == '__main__':
+    app.run(debug=True)
@@ -0,0 +1,84 @@
+"""Wall-clock time of an HLS ladder transcode: one ffmpeg vs segment-parallel.
+
+Usage:
+    python benchmarks/segment_transcode.py [VIDEO] [--duration 600] [--workers N] [--chunk 60]
+
+Without VIDEO a synthetic 1080p H.264 + AAC clip is generated with ffmpeg
+first. "single ffmpeg" is transcode.transcode_hls with ffmpeg's own
+threading; the other row is transcode.transcode_hls_segmented with
+--workers ffmpeg processes (default: one per core) driven from a thread
+pool.
+
+The segmented path is off in the app (TRANSCODE_SEGMENT_WORKERS=1) until
+a run like this shows it winning on the host. Measured so far:
+
+    --duration 120 --chunk 20, preset veryfast, 1 core
+    single ffmpeg                          335.9s
+    segmented, 1 workers                   371.4s    0.90x
+
+With one core nothing runs in parallel; the 10% is the split, separate
+audio encode and concat. No multi-core run has been recorded yet.
+"""
+import argparse
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from thumbnails import FFMPEG
+from transcode import transcode_hls, transcode_hls_segmented
+
+HEIGHTS = (1080, 720, 480, 360)
+
+
+def make_sample(path, duration):
+    print(f'Generating {duration}s 1920x1080 sample at {path} ...')
+    subprocess.run([
+        FFMPEG, '-v', 'error', '-y',
+        '-f', 'lavfi', '-i', f'testsrc2=size=1920x1080:rate=30:duration={duration}',
+        '-f', 'lavfi', '-i', f'sine=frequency=440:duration={duration}',
+        '-c:v', 'libx264', '-preset', 'ultrafast', '-g', '60', '-pix_fmt', 'yuv420p',
+        '-c:a', 'aac', '-shortest', path
+    ], check=True)
+
+
+def time_transcode(fn, video_path, **options):
+    out_dir = tempfile.mkdtemp(prefix='transcode_bench_')
+    try:
+        started = time.perf_counter()
+        fn(video_path, os.path.join(out_dir, 'video.hls', 'master.m3u8'), 1080, True, HEIGHTS, **options)
+        return time.perf_counter() - started
+    finally:
+        shutil.rmtree(out_dir, ignore_errors=True)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('video', nargs='?')
+    parser.add_argument('--duration', type=int, default=600, help='Length of the generated sample in seconds')
+    parser.add_argument('--workers', type=int, default=os.cpu_count())
+    parser.add_argument('--chunk', type=int, default=60, help='Seconds per chunk for the segmented transcode')
+    parser.add_argument('--preset', default='veryfast')
+    args = parser.parse_args()
+
+    video_path = args.video
+    if not video_path:
+        video_path = os.path.join(tempfile.gettempdir(), f'transcode_bench_1080p_{args.duration}s.mp4')
+        if not os.path.exists(video_path):
+            make_sample(video_path, args.duration)
+
+    print(f'{video_path}: ladder {HEIGHTS}, preset {args.preset}, {os.cpu_count()} cores')
+    single = time_transcode(transcode_hls, video_path, preset=args.preset)
+    print(f"{'single ffmpeg':<34}{single:>10.1f}s")
+    segmented = time_transcode(transcode_hls_segmented, video_path, preset=args.preset,
+                               workers=args.workers, chunk_seconds=args.chunk)
+    name = f'segmented, {args.workers} workers'
+    print(f'{name:<34}{segmented:>10.1f}s{single / segmented:>8.2f}x')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,106 @@
+"""Time to fetch the best YouTube thumbnail: sequential GETs vs concurrent probes.
+
+Usage:
+    python benchmarks/thumbnail_probe.py [--videos 20] [--latency 0.08] [--connect-latency 0.1]
+
+A local stand-in for img.youtube.com answers every request after
+--latency seconds and every new connection after --connect-latency
+more (standing in for TCP + TLS setup). Like many real videos, none of
+them has a maxresdefault.jpg. "before" is the original loop: a fresh
+requests.get per candidate, one after another; "after" is
+youtube.fetch_first_available through the shared http_client.
+"""
+import argparse
+import os
+import statistics
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import requests
+
+from youtube import fetch_first_available, thumbnail_urls
+
+IMAGE = b'\xff\xd8' + b'\0' * 60 * 1024  # A stand-in 60KB "JPEG"
+
+
+def make_handler(latency, connect_latency):
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'  # Keep-alive, so pooled connections are reused
+
+        def setup(self):
+            time.sleep(connect_latency)
+            super().setup()
+
+        def log_message(self, *args):
+            pass
+
+        def _respond(self, body):
+            time.sleep(latency)
+            found = not self.path.endswith('/maxresdefault.jpg')
+            self.send_response(200 if found else 404)
+            self.send_header('Content-Type', 'image/jpeg')
+            self.send_header('Content-Length', str(len(IMAGE) if found else 0))
+            self.end_headers()
+            if found and body:
+                self.wfile.write(IMAGE)
+
+        def do_HEAD(self):
+            self._respond(False)
+
+        def do_GET(self):
+            self._respond(True)
+
+    return Handler
+
+
+def legacy_fetch(urls):
+    for url in urls:
+        response = requests.get(url)
+        if response.status_code == 200:
+            return response.content
+    return None
+
+
+def time_fetches(fetch, host, videos):
+    samples = []
+    for index in range(videos):
+        started = time.perf_counter()
+        content = fetch(thumbnail_urls(f'video{index:06d}', host))
+        samples.append(time.perf_counter() - started)
+        if content is None:
+            return None
+    return samples
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--videos', type=int, default=20)
+    parser.add_argument('--latency', type=float, default=0.08, help='Seconds added to every response')
+    parser.add_argument('--connect-latency', type=float, default=0.1, help='Seconds added to every new connection')
+    args = parser.parse_args()
+
+    server = ThreadingHTTPServer(('127.0.0.1', 0), make_handler(args.latency, args.connect_latency))
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    host = f'http://127.0.0.1:{server.server_address[1]}'
+
+    print(f'{args.videos} videos without maxres, {args.latency * 1000:.0f}ms per response, '
+          f'{args.connect_latency * 1000:.0f}ms per new connection')
+    print(f"{'strategy':<34}{'median':>10}{'total':>10}")
+    for name, fetch in [
+        ('before: sequential requests.get', legacy_fetch),
+        ('after: concurrent probe + pool', fetch_first_available),
+    ]:
+        samples = time_fetches(fetch, host, args.videos)
+        if samples is None:
+            print(f'{name:<34}{"failed":>10}')
+            continue
+        print(f'{name:<34}{statistics.median(samples):>9.3f}s{sum(samples):>9.2f}s')
+    server.shutdown()
+
+
+if __name__ == '__main__':
+    main()
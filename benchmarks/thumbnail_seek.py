@@ -0,0 +1,93 @@
+"""Time per thumbnail for each seek strategy on a long 4K file.
+
+Usage:
+    python benchmarks/thumbnail_seek.py [VIDEO] [--duration 600] [--runs 3]
+
+Without VIDEO a synthetic 4K H.264 clip is generated with ffmpeg first.
+"before" is the original cv2 CAP_PROP_POS_FRAMES seek; the other rows use
+thumbnails.read_frame.
+"""
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import cv2
+
+from thumbnails import FFMPEG, read_frame
+
+
+def make_sample(path, duration):
+    print(f'Generating {duration}s 3840x2160 sample at {path} ...')
+    subprocess.run([
+        FFMPEG, '-v', 'error', '-y',
+        '-f', 'lavfi', '-i', f'testsrc2=size=3840x2160:rate=30:duration={duration}',
+        '-c:v', 'libx264', '-preset', 'ultrafast', '-g', '300', '-pix_fmt', 'yuv420p',
+        path
+    ], check=True)
+
+
+def legacy_seek(video_path, seconds):
+    cap = cv2.VideoCapture(video_path)
+    fps = cap.get(cv2.CAP_PROP_FPS)
+    cap.set(cv2.CAP_PROP_POS_FRAMES, int(fps * seconds))
+    ret, frame = cap.read()
+    cap.release()
+    return frame if ret else None
+
+
+def time_call(fn, runs):
+    samples = []
+    for _ in range(runs):
+        started = time.perf_counter()
+        frame = fn()
+        samples.append(time.perf_counter() - started)
+        if frame is None:
+            return None
+    return statistics.median(samples)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('video', nargs='?')
+    parser.add_argument('--duration', type=int, default=600, help='Length of the generated sample in seconds')
+    parser.add_argument('--runs', type=int, default=3)
+    args = parser.parse_args()
+
+    video_path = args.video
+    if not video_path:
+        video_path = os.path.join(tempfile.gettempdir(), f'seek_bench_4k_{args.duration}s.mp4')
+        if not os.path.exists(video_path):
+            make_sample(video_path, args.duration)
+
+    cap = cv2.VideoCapture(video_path)
+    frames = cap.get(cv2.CAP_PROP_FRAME_COUNT)
+    fps = cap.get(cv2.CAP_PROP_FPS)
+    cap.release()
+    duration = frames / fps if fps else args.duration
+
+    strategies = [
+        ('before: cv2 POS_FRAMES', legacy_seek),
+        ('cv2 POS_MSEC', lambda p, s: read_frame(p, s, 'cv2')),
+        ('ffmpeg -ss accurate', lambda p, s: read_frame(p, s, 'accurate')),
+        ('ffmpeg -ss keyframe', lambda p, s: read_frame(p, s, 'keyframe')),
+    ]
+    offsets = [1.0, duration * 0.25, duration * 0.5, duration * 0.9]
+
+    print(f'{video_path}: {duration:.0f}s, median of {args.runs} runs (seconds per thumbnail)')
+    print(f"{'strategy':<26}" + ''.join(f'{f"@{o:.0f}s":>12}' for o in offsets))
+    for name, fn in strategies:
+        row = []
+        for offset in offsets:
+            seconds = time_call(lambda: fn(video_path, offset), args.runs)
+            row.append('failed' if seconds is None else f'{seconds:.3f}')
+        print(f'{name:<26}' + ''.join(f'{cell:>12}' for cell in row))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,300 @@
+"""Decode-free container parsing for MP4/MOV (ISO BMFF) and Matroska/WebM.
+
+Only the header structures are touched: the file is mmap'd and the
+parser walks box/element headers, skipping payloads (mdat, clusters)
+without reading them, so the cost is a handful of page faults however
+large the file is.
+"""
+import mmap
+import struct
+
+# Top-level box types that may open an ISO BMFF file
+MP4_LEADING_BOXES = {b'ftyp', b'moov', b'mdat', b'free', b'skip', b'wide', b'pnot'}
+EBML_MAGIC = b'\x1a\x45\xdf\xa3'
+SNIFF_SIZE = 12  # Bytes sniff_container() needs to recognise every format
+
+MP4_CODECS = {
+    'avc1': 'h264', 'avc3': 'h264', 'hvc1': 'hevc', 'hev1': 'hevc', 'vp09': 'vp9', 'av01': 'av1',
+    'mp4v': 'mpeg4', 'mp4a': 'aac', 'opus': 'opus', '.mp3': 'mp3', 'ac-3': 'ac3', 'ec-3': 'eac3',
+    'jpeg': 'mjpeg', 'apch': 'prores', 'apcn': 'prores', 'apcs': 'prores', 'apco': 'prores',
+}
+MATROSKA_CODECS = {
+    'V_MPEG4/ISO/AVC': 'h264', 'V_MPEGH/ISO/HEVC': 'hevc', 'V_VP8': 'vp8', 'V_VP9': 'vp9',
+    'V_AV1': 'av1', 'V_MPEG4/ISO/ASP': 'mpeg4', 'A_AAC': 'aac', 'A_OPUS': 'opus',
+    'A_VORBIS': 'vorbis', 'A_MPEG/L3': 'mp3', 'A_AC3': 'ac3', 'A_EAC3': 'eac3', 'A_FLAC': 'flac',
+}
+
+
+class ContainerError(Exception):
+    """Raised when a file is not a well-formed container of the expected type"""
+
+
+def sniff_container(header):
+    """Identify a container from its first SNIFF_SIZE bytes; returns a name or None"""
+    if header[:4] == EBML_MAGIC:
+        return 'matroska'
+    if len(header) >= 8 and header[4:8] in MP4_LEADING_BOXES:
+        return 'mp4'
+    if header[:4] == b'RIFF' and header[8:12] == b'AVI ':
+        return 'avi'
+    if header[:3] == b'FLV':
+        return 'flv'
+    return None
+
+
+# --- ISO BMFF ---------------------------------------------------------------
+
+def iter_boxes(buf, start, end):
+    """Yield (type, payload_start, box_end) for each box in buf[start:end]"""
+    offset = start
+    while offset + 8 <= end:
+        size, box_type = struct.unpack_from('>I4s', buf, offset)
+        header = 8
+        if size == 1:
+            if offset + 16 > end:
+                raise ContainerError('truncated 64-bit box header')
+            size = struct.unpack_from('>Q', buf, offset + 8)[0]
+            header = 16
+        elif size == 0:
+            size = end - offset  # Box runs to the end of its parent
+        if size < header or offset + size > end:
+            raise ContainerError(f'box {box_type!r} at {offset} overruns its parent')
+        yield box_type, offset + header, offset + size
+        offset += size
+
+
+def _find_box(buf, start, end, box_type):
+    for child_type, payload, child_end in iter_boxes(buf, start, end):
+        if child_type == box_type:
+            return payload, child_end
+    return None
+
+
+def top_level_boxes(buf):
+    """[(type, offset, size)] for every top-level box in an ISO BMFF file"""
+    return [(box_type, payload, box_end) for box_type, payload, box_end in iter_boxes(buf, 0, len(buf))]
+
+
+def needs_faststart(path):
+    """True if an MP4/MOV file's moov box comes after its mdat.
+
+    Such files can't start playing until the player has fetched the
+    index from the end of the file.
+    """
+    with open(path, 'rb') as f:
+        try:
+            buf = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError:
+            return False
+    try:
+        if sniff_container(buf[:SNIFF_SIZE]) != 'mp4':
+            return False
+        try:
+            order = [box_type for box_type, _, _ in top_level_boxes(buf) if box_type in (b'moov', b'mdat')]
+        except (ContainerError, struct.error):
+            return False
+        return b'moov' in order and b'mdat' in order and order.index(b'mdat') < order.index(b'moov')
+    finally:
+        buf.close()
+
+
+def _parse_mp4_track(buf, start, end):
+    track = {}
+    mdia = _find_box(buf, start, end, b'mdia')
+    tkhd = _find_box(buf, start, end, b'tkhd')
+    if mdia is None:
+        return None
+    hdlr = _find_box(buf, mdia[0], mdia[1], b'hdlr')
+    if hdlr is not None:
+        track['handler'] = bytes(buf[hdlr[0] + 8:hdlr[0] + 12]).decode('latin-1')
+    if tkhd is not None:
+        # Width/height are 16.16 fixed point in the last 8 bytes of tkhd
+        width, height = struct.unpack_from('>II', buf, tkhd[1] - 8)
+        track['width'], track['height'] = width >> 16, height >> 16
+
+    mdhd = _find_box(buf, mdia[0], mdia[1], b'mdhd')
+    if mdhd is not None:
+        version = buf[mdhd[0]]
+        if version == 1:
+            timescale, duration = struct.unpack_from('>IQ', buf, mdhd[0] + 20)
+        else:
+            timescale, duration = struct.unpack_from('>II', buf, mdhd[0] + 12)
+        if timescale:
+            track['duration'] = duration / timescale
+
+    minf = _find_box(buf, mdia[0], mdia[1], b'minf')
+    stbl = minf and _find_box(buf, minf[0], minf[1], b'stbl')
+    if stbl:
+        stsd = _find_box(buf, stbl[0], stbl[1], b'stsd')
+        if stsd is not None and stsd[0] + 16 <= stsd[1]:
+            # Full box header (4) + entry count (4), then the first sample entry's size and format
+            fourcc = bytes(buf[stsd[0] + 12:stsd[0] + 16]).decode('latin-1')
+            track['codec'] = MP4_CODECS.get(fourcc.lower(), fourcc.strip().lower())
+        stsz = _find_box(buf, stbl[0], stbl[1], b'stsz')
+        if stsz is not None:
+            track['samples'] = struct.unpack_from('>I', buf, stsz[0] + 8)[0]
+    return track
+
+
+def _parse_mp4(buf):
+    moov = _find_box(buf, 0, len(buf), b'moov')
+    if moov is None:
+        raise ContainerError('no moov box')
+    info = {'container': 'mp4', 'duration': None, 'width': None, 'height': None,
+            'fps': None, 'video_codec': None, 'audio_codec': None}
+
+    mvhd = _find_box(buf, moov[0], moov[1], b'mvhd')
+    if mvhd is not None:
+        version = buf[mvhd[0]]
+        if version == 1:
+            timescale, duration = struct.unpack_from('>IQ', buf, mvhd[0] + 20)
+        else:
+            timescale, duration = struct.unpack_from('>II', buf, mvhd[0] + 12)
+        if timescale:
+            info['duration'] = duration / timescale
+
+    for box_type, payload, box_end in iter_boxes(buf, moov[0], moov[1]):
+        if box_type != b'trak':
+            continue
+        track = _parse_mp4_track(buf, payload, box_end)
+        if not track:
+            continue
+        if track.get('handler') == 'vide' and info['video_codec'] is None:
+            info['width'] = track.get('width') or None
+            info['height'] = track.get('height') or None
+            info['video_codec'] = track.get('codec')
+            if track.get('samples') and track.get('duration'):
+                info['fps'] = track['samples'] / track['duration']
+            info['duration'] = info['duration'] or track.get('duration')
+        elif track.get('handler') == 'soun' and info['audio_codec'] is None:
+            info['audio_codec'] = track.get('codec')
+    return info
+
+
+# --- Matroska / WebM ----------------------------------------------------------
+
+def _read_vint(buf, offset, strip_marker):
+    first = buf[offset]
+    length = 1
+    mask = 0x80
+    while length <= 8 and not first & mask:
+        mask >>= 1
+        length += 1
+    if length > 8:
+        raise ContainerError(f'invalid EBML variable-length integer at {offset}')
+    value = first & (mask - 1) if strip_marker else first
+    for i in range(1, length):
+        value = (value << 8) | buf[offset + i]
+    unknown = strip_marker and value == (1 << (7 * length)) - 1
+    return value, length, unknown
+
+
+def iter_elements(buf, start, end):
+    """Yield (id, payload_start, element_end) for each EBML element in buf[start:end]"""
+    offset = start
+    while offset < end:
+        element_id, id_length, _ = _read_vint(buf, offset, strip_marker=False)
+        size, size_length, unknown = _read_vint(buf, offset + id_length, strip_marker=True)
+        payload = offset + id_length + size_length
+        element_end = end if unknown else payload + size
+        if element_end > end:
+            # Truncated upload or a live recording: parse what is there
+            element_end = end
+        yield element_id, payload, element_end
+        offset = element_end
+
+
+def _uint(buf, start, end):
+    return int.from_bytes(buf[start:end], 'big')
+
+
+def _float(buf, start, end):
+    if end - start == 4:
+        return struct.unpack_from('>f', buf, start)[0]
+    if end - start == 8:
+        return struct.unpack_from('>d', buf, start)[0]
+    return None
+
+
+def _parse_matroska(buf):
+    info = {'container': 'matroska', 'duration': None, 'width': None, 'height': None,
+            'fps': None, 'video_codec': None, 'audio_codec': None}
+    elements = iter_elements(buf, 0, len(buf))
+    element_id, payload, element_end = next(elements)
+    if element_id != 0x1A45DFA3:
+        raise ContainerError('missing EBML header')
+    for child_id, child, child_end in iter_elements(buf, payload, element_end):
+        if child_id == 0x4282 and bytes(buf[child:child_end]) == b'webm':  # DocType
+            info['container'] = 'webm'
+
+    segment = next((e for e in elements if e[0] == 0x18538067), None)
+    if segment is None:
+        raise ContainerError('no Segment element')
+
+    timecode_scale, raw_duration = 1000000, None
+    for element_id, payload, element_end in iter_elements(buf, segment[1], segment[2]):
+        if element_id == 0x1F43B675:  # Cluster: media data starts, headers are done
+            break
+        if element_id == 0x1549A966:  # Info
+            for child_id, child, child_end in iter_elements(buf, payload, element_end):
+                if child_id == 0x2AD7B1:
+                    timecode_scale = _uint(buf, child, child_end)
+                elif child_id == 0x4489:
+                    raw_duration = _float(buf, child, child_end)
+        elif element_id == 0x1654AE6B:  # Tracks
+            for entry_id, entry, entry_end in iter_elements(buf, payload, element_end):
+                if entry_id == 0xAE:
+                    _parse_matroska_track(buf, entry, entry_end, info)
+
+    if raw_duration:
+        info['duration'] = raw_duration * timecode_scale / 1e9
+    return info
+
+
+def _parse_matroska_track(buf, start, end, info):
+    track_type, codec, width, height, frame_ns = None, None, None, None, None
+    for element_id, payload, element_end in iter_elements(buf, start, end):
+        if element_id == 0x83:
+            track_type = _uint(buf, payload, element_end)
+        elif element_id == 0x86:
+            codec_id = bytes(buf[payload:element_end]).rstrip(b'\x00').decode('ascii', 'replace')
+            codec = MATROSKA_CODECS.get(codec_id, codec_id.lower())
+        elif element_id == 0x23E383:
+            frame_ns = _uint(buf, payload, element_end)
+        elif element_id == 0xE0:
+            for child_id, child, child_end in iter_elements(buf, payload, element_end):
+                if child_id == 0xB0:
+                    width = _uint(buf, child, child_end)
+                elif child_id == 0xBA:
+                    height = _uint(buf, child, child_end)
+    if track_type == 1 and info['video_codec'] is None:
+        info['video_codec'], info['width'], info['height'] = codec, width, height
+        if frame_ns:
+            info['fps'] = 1e9 / frame_ns
+    elif track_type == 2 and info['audio_codec'] is None:
+        info['audio_codec'] = codec
+
+
+def read_container_info(path):
+    """Parse duration, resolution, fps and codecs from an MP4/MOV/MKV/WebM header.
+
+    Raises ContainerError when the file is not one of those containers or
+    its header structures are malformed.
+    """
+    with open(path, 'rb') as f:
+        try:
+            buf = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError:
+            raise ContainerError('empty file')
+    try:
+        kind = sniff_container(buf[:12])
+        try:
+            if kind == 'mp4':
+                return _parse_mp4(buf)
+            if kind == 'matroska':
+                return _parse_matroska(buf)
+        except (struct.error, IndexError, StopIteration) as e:
+            raise ContainerError(f'malformed {kind} header: {e}')
+        raise ContainerError(f'unsupported container: {kind or "unknown"}')
+    finally:
+        buf.close()
@@ -0,0 +1,151 @@
+"""Shared client for every outbound HTTP fetch (thumbnails, oEmbed, metadata).
+
+One requests session with a keep-alive connection pool per host, so bulk
+imports reuse connections instead of paying TCP + TLS setup per image.
+On top of it:
+
+- default (connect, read) timeouts on every request;
+- retries of idempotent requests on connection errors, timeouts and
+  429/502/503/504, with exponential backoff and full jitter (honouring
+  a short Retry-After);
+- a circuit breaker per host: after `failure_threshold` consecutive
+  failures, requests to that host fail at once with CircuitOpenError
+  for `reset_after` seconds, then a single trial request decides
+  whether it closes again.
+
+Only 429 and 500/502/503/504 count as failures; anything else is an
+answer (probes expect 404s, and some servers refuse HEAD with 501).
+"""
+import random
+import threading
+import time
+from urllib.parse import urlsplit
+
+import requests
+from requests.adapters import HTTPAdapter
+
+RETRY_STATUSES = {429, 502, 503, 504}
+# Statuses that say the host is unhealthy; others (404, 501 for HEAD...) are answers
+FAILURE_STATUSES = RETRY_STATUSES | {500}
+IDEMPOTENT_METHODS = {'GET', 'HEAD', 'OPTIONS'}
+
+
+class CircuitOpenError(requests.ConnectionError):
+    """Raised without a request being made while a host's circuit is open"""
+
+
+class CircuitBreaker:
+    """Consecutive-failure breaker for one host"""
+
+    def __init__(self, failure_threshold, reset_after):
+        self.failure_threshold = failure_threshold
+        self.reset_after = reset_after
+        self.failures = 0
+        self.opened_at = None
+        self.trial_running = False
+        self.changed = threading.Condition()
+
+    def allow(self):
+        with self.changed:
+            while self.trial_running:
+                # Another request is testing the host; go by its outcome
+                # rather than failing a burst of concurrent callers
+                if not self.changed.wait(self.reset_after):
+                    return False
+            if self.opened_at is None:
+                return True
+            if time.monotonic() - self.opened_at < self.reset_after:
+                return False
+            # Half-open: let one request through to test the host
+            self.trial_running = True
+            return True
+
+    def record(self, success):
+        with self.changed:
+            self.trial_running = False
+            self.changed.notify_all()
+            if success:
+                self.failures = 0
+                self.opened_at = None
+                return
+            self.failures += 1
+            if self.failures >= self.failure_threshold:
+                self.opened_at = time.monotonic()
+
+
+class HttpClient:
+    def __init__(self, timeout=(3.05, 15), retries=2, backoff=0.25, max_backoff=4.0,
+                 failure_threshold=5, reset_after=30.0, pool_size=16, max_hosts=32):
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.failure_threshold = failure_threshold
+        self.reset_after = reset_after
+        self.max_hosts = max_hosts
+        self.session = requests.Session()
+        self.set_pool_size(pool_size)
+        self.breakers = {}
+        self.lock = threading.Lock()
+
+    def set_pool_size(self, pool_size):
+        """Keep up to pool_size connections per host; connections already pooled are dropped"""
+        self.pool_size = pool_size
+        # pool_connections is how many per-host pools are kept,
+        # pool_maxsize how many connections each of them holds
+        adapter = HTTPAdapter(pool_connections=self.max_hosts, pool_maxsize=pool_size)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+    def breaker(self, url):
+        host = urlsplit(url).netloc
+        with self.lock:
+            if host not in self.breakers:
+                self.breakers[host] = CircuitBreaker(self.failure_threshold, self.reset_after)
+            return self.breakers[host]
+
+    def _delay(self, attempt, response=None):
+        delay = random.uniform(0, min(self.max_backoff, self.backoff * 2 ** attempt))
+        retry_after = response.headers.get('Retry-After') if response is not None else None
+        if retry_after and retry_after.isdigit():
+            delay = max(delay, min(int(retry_after), self.max_backoff))
+        return delay
+
+    def request(self, method, url, **kwargs):
+        """Like requests.request, through the pool, breaker and retry policy"""
+        kwargs.setdefault('timeout', self.timeout)
+        breaker = self.breaker(url)
+        attempts = 1 + (self.retries if method.upper() in IDEMPOTENT_METHODS else 0)
+        for attempt in range(attempts):
+            if not breaker.allow():
+                raise CircuitOpenError(f'circuit open for {urlsplit(url).netloc}')
+            try:
+                response = self.session.request(method, url, **kwargs)
+            except (requests.ConnectionError, requests.Timeout):
+                breaker.record(False)
+                if attempt == attempts - 1:
+                    raise
+                time.sleep(self._delay(attempt))
+                continue
+            except Exception:
+                # Redirect loops, broken bodies...: still a failure, and it
+                # must settle a half-open trial or the host stays blocked
+                breaker.record(False)
+                raise
+            breaker.record(response.status_code not in FAILURE_STATUSES)
+            if response.status_code not in RETRY_STATUSES or attempt == attempts - 1:
+                return response
+            response.close()
+            time.sleep(self._delay(attempt, response))
+
+    def get(self, url, **kwargs):
+        return self.request('GET', url, **kwargs)
+
+    def head(self, url, **kwargs):
+        kwargs.setdefault('allow_redirects', True)
+        return self.request('HEAD', url, **kwargs)
+
+
+# The process-wide client: share it so connections are reused across
+# callers (app.py sizes its pools from HTTP_POOL_SIZE)
+client = HttpClient()
@@ -0,0 +1,131 @@
+import json
+import time
+
+import sqlite_file
+
+
+class JobQueue:
+    """Persistent job queue backed by a SQLite file shared between processes"""
+
+    def __init__(self, path, max_attempts=3, retry_delay=30, lock_timeout=600):
+        self.path = path
+        self.max_attempts = max_attempts
+        self.retry_delay = retry_delay
+        self.lock_timeout = lock_timeout
+        with sqlite_file.create(self.path) as conn:
+            conn.execute('''
+                CREATE TABLE IF NOT EXISTS job (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    kind TEXT NOT NULL,
+                    payload TEXT NOT NULL,
+                    status TEXT NOT NULL DEFAULT 'pending',
+                    attempts INTEGER NOT NULL DEFAULT 0,
+                    last_error TEXT,
+                    run_at REAL NOT NULL,
+                    locked_at REAL,
+                    created_at REAL NOT NULL,
+                    finished_at REAL
+                )
+            ''')
+            conn.execute('CREATE INDEX IF NOT EXISTS ix_job_status_run_at ON job (status, run_at)')
+
+    def _connect(self):
+        return sqlite_file.connect(self.path)
+
+    def enqueue(self, kind, payload, delay=0):
+        """Add a job and return its id"""
+        now = time.time()
+        with self._connect() as conn:
+            cursor = conn.execute(
+                'INSERT INTO job (kind, payload, run_at, created_at) VALUES (?, ?, ?, ?)',
+                (kind, json.dumps(payload), now + delay, now)
+            )
+            return cursor.lastrowid
+
+    def claim(self, kinds=None):
+        """Atomically take the next runnable job (of one of `kinds`, if given), or return None"""
+        now = time.time()
+        kind_filter = ''
+        if kinds is not None:
+            kind_filter = f"AND kind IN ({', '.join('?' * len(kinds))})"
+        with self._connect() as conn:
+            # BEGIN IMMEDIATE takes the write lock up front so two workers
+            # can never pick the same row
+            conn.execute('BEGIN IMMEDIATE')
+            try:
+                row = conn.execute(f'''
+                    SELECT id, kind, payload, attempts FROM job
+                    WHERE ((status = 'pending' AND run_at <= ?)
+                       OR (status = 'running' AND locked_at < ?)) {kind_filter}
+                    ORDER BY run_at, id LIMIT 1
+                ''', (now, now - self.lock_timeout, *(kinds or ()))).fetchone()
+                if row is not None:
+                    conn.execute(
+                        "UPDATE job SET status = 'running', locked_at = ?, attempts = attempts + 1 WHERE id = ?",
+                        (now, row[0])
+                    )
+                conn.execute('COMMIT')
+            except Exception:
+                conn.execute('ROLLBACK')
+                raise
+        if row is None:
+            return None
+        return {'id': row[0], 'kind': row[1], 'payload': json.loads(row[2]), 'attempts': row[3] + 1}
+
+    def touch(self, job_id):
+        """Heartbeat for a long-running job so it isn't reclaimed as stale"""
+        with self._connect() as conn:
+            conn.execute("UPDATE job SET locked_at = ? WHERE id = ? AND status = 'running'", (time.time(), job_id))
+
+    def complete(self, job_id):
+        with self._connect() as conn:
+            conn.execute(
+                "UPDATE job SET status = 'done', locked_at = NULL, finished_at = ? WHERE id = ?",
+                (time.time(), job_id)
+            )
+
+    def fail(self, job_id, error):
+        """Record a failure; returns True when the job has been dead-lettered"""
+        now = time.time()
+        with self._connect() as conn:
+            row = conn.execute('SELECT attempts FROM job WHERE id = ?', (job_id,)).fetchone()
+            if row is None:
+                return False
+            attempts = row[0]
+            if attempts >= self.max_attempts:
+                conn.execute(
+                    "UPDATE job SET status = 'dead', last_error = ?, locked_at = NULL, finished_at = ? WHERE id = ?",
+                    (str(error), now, job_id)
+                )
+                return True
+            # Exponential backoff between attempts
+            run_at = now + self.retry_delay * (2 ** (attempts - 1))
+            conn.execute(
+                "UPDATE job SET status = 'pending', last_error = ?, locked_at = NULL, run_at = ? WHERE id = ?",
+                (str(error), run_at, job_id)
+            )
+            return False
+
+    def requeue_dead(self):
+        """Give every dead-lettered job a fresh set of attempts"""
+        with self._connect() as conn:
+            cursor = conn.execute(
+                "UPDATE job SET status = 'pending', attempts = 0, run_at = ?, finished_at = NULL WHERE status = 'dead'",
+                (time.time(),)
+            )
+            return cursor.rowcount
+
+    def dead_letters(self):
+        with self._connect() as conn:
+            rows = conn.execute(
+                "SELECT id, kind, payload, attempts, last_error FROM job WHERE status = 'dead' ORDER BY id"
+            ).fetchall()
+        return [
+            {'id': r[0], 'kind': r[1], 'payload': json.loads(r[2]), 'attempts': r[3], 'last_error': r[4]}
+            for r in rows
+        ]
+
+    def counts(self):
+        with self._connect() as conn:
+            rows = conn.execute('SELECT status, COUNT(*) FROM job GROUP BY status').fetchall()
+        return {status: count for status, count in rows}
@@ -0,0 +1,267 @@
+"""Bulk import of a YouTube playlist or channel into a category.
+
+One yt-dlp call with extract_flat lists every video (id, title,
+duration) without visiting the videos themselves. The list is stored as
+YoutubeImportItem rows, then thumbnails are fetched at most
+YOUTUBE_IMPORT_CONCURRENCY at a time, straight from the image host
+(youtube.thumbnail_urls), through the shared http_client (its pool,
+retries and circuit breaker). The asyncio loop only schedules: every
+fetch is a blocking requests call run in a thread (run_in_executor),
+which keeps the one HTTP client and adds no aiohttp dependency; the
+thumbnail encoding that follows each fetch needs a thread anyway. The new Video rows and item
+statuses are committed YOUTUBE_IMPORT_BATCH_SIZE at a time, so progress
+is never more than one batch behind. A video whose fetch runs into
+network trouble or a failing host stays 'pending' and the run ends with
+ImportIncomplete; running the import again (the worker retries it)
+resumes it, fetching only the items still 'pending'.
+
+Queued by POST /imports and run by the worker, or run directly:
+    python playlist_import.py URL --category NAME
+    python playlist_import.py --resume IMPORT_ID
+"""
+import argparse
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from io import BytesIO
+
+import numpy as np
+import requests
+import yt_dlp
+from PIL import Image
+from sqlalchemy import insert, update
+
+from app import app, db, Category, Video, YoutubeImport, YoutubeImportItem, thumbnail_store
+import http_client
+from http_client import FAILURE_STATUSES, CircuitOpenError
+from thumbnails import write_thumbnail_set
+from youtube import THUMBNAIL_NAMES, extract_video_id, fetch_first_available, thumbnail_urls
+
+# Titles yt-dlp gives playlist entries that can't be watched
+UNAVAILABLE_TITLES = {'[Private video]', '[Deleted video]'}
+
+
+def expand(source_url):
+    """(video_id, title, duration) for every video of a playlist or channel, in order"""
+    ydl_opts = {
+        'quiet': True,
+        'no_warnings': True,
+        'extract_flat': 'in_playlist',
+    }
+    with yt_dlp.YoutubeDL(ydl_opts) as ydl:
+        info = ydl.extract_info(source_url, download=False)
+        entries = list(info.get('entries') or [])
+        videos = []
+        while entries:
+            entry = entries.pop(0)
+            video_id = entry.get('id')
+            if video_id and len(video_id) == 11 and entry.get('ie_key', 'Youtube') == 'Youtube':
+                videos.append((video_id, entry.get('title'), entry.get('duration')))
+            elif entry.get('url'):
+                # A channel lists its tabs (videos, shorts, live) as nested playlists
+                nested = ydl.extract_info(entry['url'], download=False)
+                entries[:0] = nested.get('entries') or []
+    return videos
+
+
+def expand_import(youtube_import):
+    """Store the import's video list as pending items, in one transaction"""
+    existing = {
+        extract_video_id(url) for (url,) in
+        db.session.query(Video.youtube_url).filter_by(category_id=youtube_import.category_id, is_youtube=True)
+    }
+    rows = []
+    seen = set()
+    for video_id, title, duration in expand(youtube_import.source_url):
+        if video_id in seen:
+            continue
+        seen.add(video_id)
+        status, error = 'pending', None
+        if video_id in existing:
+            status, error = 'skipped', 'already in this category'
+        elif title in UNAVAILABLE_TITLES:
+            status, error = 'skipped', 'private or deleted'
+        rows.append({
+            'import_id': youtube_import.id, 'position': len(rows), 'youtube_id': video_id,
+            'title': (title or 'YouTube Video')[:200], 'duration': duration, 'status': status, 'error': error,
+        })
+    if rows:
+        db.session.execute(insert(YoutubeImportItem), rows)
+    youtube_import.status = 'importing'
+    db.session.commit()
+    return len(rows)
+
+
+def fetch_thumbnail_set(video_id, probe_pool=None):
+    """Download a video's best thumbnail and store its renditions; returns the variants"""
+    content = fetch_first_available(thumbnail_urls(video_id, app.config['YOUTUBE_IMAGE_HOST']), executor=probe_pool)
+    if content is None:
+        raise ValueError('no thumbnail could be downloaded')
+    frame = np.asarray(Image.open(BytesIO(content)).convert('RGB'))[:, :, ::-1]  # OpenCV wants BGR
+    return write_thumbnail_set(frame, thumbnail_store, app.config['THUMBNAIL_WIDTHS'], app.config['THUMBNAIL_ENCODERS'])
+
+
+def is_transient(error):
+    """True for network trouble or a failing host, which a later run may get past; False for a missing thumbnail"""
+    if isinstance(error, requests.HTTPError):
+        return error.response is not None and error.response.status_code in FAILURE_STATUSES
+    return isinstance(error, requests.RequestException)
+
+
+class ImportIncomplete(Exception):
+    """Raised when videos were left pending after transient errors; running the import again resumes"""
+
+
+async def fetch_all(items, concurrency, on_result):
+    """Fetch thumbnails for items, `concurrency` at a time; on_result(item, variants, error) as each finishes.
+
+    Once the image host's circuit opens, the items not started yet are
+    reported with that error straight away instead of being fetched.
+    """
+    loop = asyncio.get_running_loop()
+    semaphore = asyncio.Semaphore(concurrency)
+    circuit_open = None
+    # Every video probes all its candidate URLs at once, so the probes get
+    # their own threads (a fetch thread waits on them) and the shared
+    # client's per-host pool has to hold that many connections
+    probes = concurrency * len(THUMBNAIL_NAMES)
+    if http_client.client.pool_size < probes:
+        http_client.client.set_pool_size(probes)  # --concurrency above the configured pool
+    # Fetches block on HTTP and on encoding, so they run in threads
+    with ThreadPoolExecutor(max_workers=concurrency) as pool, \
+            ThreadPoolExecutor(max_workers=probes, thread_name_prefix='import-probe') as probe_pool:
+        async def fetch(item):
+            nonlocal circuit_open
+            async with semaphore:
+                if circuit_open is not None:
+                    return item, None, circuit_open
+                try:
+                    variants = await loop.run_in_executor(pool, fetch_thumbnail_set, item.youtube_id, probe_pool)
+                    return item, variants, None
+                except CircuitOpenError as e:
+                    circuit_open = e
+                    return item, None, e
+                except Exception as e:
+                    return item, None, e
+
+        for future in asyncio.as_completed([fetch(item) for item in items]):
+            on_result(*await future)
+
+
+def run_import(import_id, concurrency=None, batch_size=None, progress=None):
+    """Expand (first time only) and import a YoutubeImport; call inside an app context.
+
+    Videos whose fetch hit a transient error stay 'pending' and
+    ImportIncomplete is raised, so a worker retry (or --resume) picks
+    them up later; only a thumbnail that doesn't exist marks one 'failed'.
+    """
+    concurrency = concurrency or app.config['YOUTUBE_IMPORT_CONCURRENCY']
+    batch_size = batch_size or app.config['YOUTUBE_IMPORT_BATCH_SIZE']
+    youtube_import = db.session.get(YoutubeImport, import_id)
+    if youtube_import is None:
+        return
+    if youtube_import.status == 'pending':
+        expand_import(youtube_import)
+    category_id = youtube_import.category_id
+
+    # Plain rows, not ORM objects: every commit would expire the objects
+    # still waiting for their fetch, and reading one back is a SELECT each
+    items = db.session.query(
+        YoutubeImportItem.id, YoutubeImportItem.youtube_id, YoutubeImportItem.title, YoutubeImportItem.duration
+    ).filter_by(import_id=import_id, status='pending').order_by(YoutubeImportItem.position).all()
+    total = YoutubeImportItem.query.filter_by(import_id=import_id).count()
+    finished = total - len(items)
+    left_pending = 0
+    batch = []
+
+    def flush():
+        updates = []
+        videos = []
+        for item, variants, error in batch:
+            if error:
+                updates.append({'id': item.id, 'status': 'failed', 'error': str(error)[:300]})
+                continue
+            video = Video(
+                title=item.title,
+                youtube_url=f'https://www.youtube.com/watch?v={item.youtube_id}',
+                is_youtube=True,
+                category_id=category_id,
+                duration=item.duration
+            )
+            video.set_thumbnails(variants)
+            videos.append((item, video))
+        db.session.add_all(video for _, video in videos)
+        db.session.flush()
+        updates += [{'id': item.id, 'status': 'done', 'video_id': video.id} for item, video in videos]
+        if updates:
+            db.session.execute(update(YoutubeImportItem), updates)
+        db.session.commit()
+        batch.clear()
+
+    def on_result(item, variants, error):
+        nonlocal finished, left_pending
+        if error is not None and is_transient(error):
+            left_pending += 1
+        else:
+            finished += 1
+            batch.append((item, variants, error))
+        if progress:
+            progress(finished, total, item, error)
+        if len(batch) >= batch_size:
+            flush()
+
+    asyncio.run(fetch_all(items, concurrency, on_result))
+    flush()
+    if left_pending:
+        raise ImportIncomplete(f'{left_pending} videos left pending after network errors; run the import again to resume')
+    youtube_import.status = 'done'
+    db.session.commit()
+    return youtube_import.summary()
+
+
+def print_progress(finished, total, item, error):
+    if error is None:
+        outcome = 'done'
+    elif is_transient(error):
+        outcome = f'left pending: {error}'
+    else:
+        outcome = f'failed: {error}'
+    print(f'[{finished}/{total}] {item.youtube_id} {item.title}: {outcome}')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Import every video of a YouTube playlist or channel')
+    parser.add_argument('url', nargs='?', help='Playlist or channel URL')
+    parser.add_argument('--category', help='Category name (created if missing)')
+    parser.add_argument('--resume', metavar='IMPORT_ID', help='Continue an interrupted import')
+    parser.add_argument('--concurrency', type=int, default=app.config['YOUTUBE_IMPORT_CONCURRENCY'],
+                        help='Thumbnails fetched at once')
+    args = parser.parse_args()
+
+    with app.app_context():
+        if args.resume:
+            import_id = args.resume
+        else:
+            if not args.url or not args.category:
+                parser.error('give a URL and --category, or --resume')
+            category = Category.query.filter_by(name=args.category).first()
+            if category is None:
+                category = Category(name=args.category)
+                db.session.add(category)
+                db.session.commit()
+            # The same playlist and category again picks up where the last run stopped
+            youtube_import = YoutubeImport.query.filter(
+                YoutubeImport.source_url == args.url, YoutubeImport.category_id == category.id,
+                YoutubeImport.status.in_(('pending', 'importing'))
+            ).first()
+            if youtube_import is None:
+                youtube_import = YoutubeImport(source_url=args.url, category_id=category.id)
+                db.session.add(youtube_import)
+                db.session.commit()
+            import_id = youtube_import.id
+        print(f'Import {import_id}')
+        try:
+            summary = run_import(import_id, concurrency=args.concurrency, progress=print_progress)
+        except ImportIncomplete as e:
+            print(f'Stopped: {e} (--resume {import_id})')
+            raise SystemExit(1)
+        print(f"Finished: {summary['counts'] if summary else 'no such import'}")
@@ -0,0 +1,136 @@
+import json
+import os
+import shutil
+import subprocess
+
+import cv2
+
+from container import ContainerError, read_container_info, sniff_container
+
+FFPROBE = os.environ.get('FFPROBE_BINARY', 'ffprobe')
+
+# OpenCV reports codecs as FourCC tags; map the common ones to ffprobe names
+FOURCC_CODECS = {
+    'avc1': 'h264', 'h264': 'h264', 'x264': 'h264',
+    'hvc1': 'hevc', 'hev1': 'hevc', 'h265': 'hevc',
+    'vp08': 'vp8', 'vp80': 'vp8', 'vp09': 'vp9', 'vp90': 'vp9',
+    'av01': 'av1', 'mp4v': 'mpeg4', 'fmp4': 'mpeg4', 'xvid': 'mpeg4', 'divx': 'mpeg4',
+    'flv1': 'flv1', 'mjpg': 'mjpeg',
+}
+
+
+def _probe_ffprobe(video_path, timeout=30):
+    cmd = [FFPROBE, '-v', 'error', '-print_format', 'json', '-show_format', '-show_streams', video_path]
+    result = subprocess.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, timeout=timeout)
+    if result.returncode != 0:
+        return None
+    info = json.loads(result.stdout or b'{}')
+    streams = info.get('streams', [])
+    video = next((s for s in streams if s.get('codec_type') == 'video'), None)
+    audio = next((s for s in streams if s.get('codec_type') == 'audio'), None)
+    if video is None:
+        return None
+    fmt = info.get('format', {})
+
+    def number(value, cast=float):
+        try:
+            return cast(value)
+        except (TypeError, ValueError):
+            return None
+
+    rate = video.get('avg_frame_rate') or video.get('r_frame_rate') or ''
+    numerator, _, denominator = rate.partition('/')
+    fps = number(numerator)
+    if fps is not None and number(denominator):
+        fps /= number(denominator)
+
+    return {
+        'duration': number(fmt.get('duration')) or number(video.get('duration')),
+        'width': number(video.get('width'), int),
+        'height': number(video.get('height'), int),
+        'fps': fps or None,
+        'video_codec': video.get('codec_name'),
+        'audio_codec': audio.get('codec_name') if audio else None,
+        'bitrate': number(fmt.get('bit_rate'), int),
+        'container': fmt.get('format_name'),
+    }
+
+
+def _probe_cv2(video_path):
+    cap = cv2.VideoCapture(video_path)
+    try:
+        if not cap.isOpened():
+            return None
+        width = int(cap.get(cv2.CAP_PROP_FRAME_WIDTH))
+        height = int(cap.get(cv2.CAP_PROP_FRAME_HEIGHT))
+        fps = cap.get(cv2.CAP_PROP_FPS)
+        frame_count = cap.get(cv2.CAP_PROP_FRAME_COUNT)
+        fourcc = int(cap.get(cv2.CAP_PROP_FOURCC))
+    finally:
+        cap.release()
+    tag = ''.join(chr((fourcc >> (8 * i)) & 0xFF) for i in range(4)).strip('\x00 ').lower()
+    return {
+        'duration': frame_count / fps if fps > 0 and frame_count > 0 else None,
+        'width': width or None,
+        'height': height or None,
+        'fps': fps or None,
+        'video_codec': FOURCC_CODECS.get(tag, tag or None),
+        'audio_codec': None,
+        'bitrate': None,
+        'container': None,
+    }
+
+
+def probe_video(video_path):
+    """Technical metadata for a video file.
+
+    MP4/MOV/MKV/WebM headers are parsed directly (container.py); ffprobe
+    and then OpenCV are only used when that fails or comes back
+    incomplete. Returns a dict with duration (seconds), width, height,
+    fps, video_codec, audio_codec, bitrate (bits/s), container and
+    file_size (bytes); fields that could not be determined are None.
+    """
+    metadata = None
+    try:
+        info = read_container_info(video_path)
+        if info['duration'] and info['width'] and info['height']:
+            metadata = dict(info, bitrate=None)
+    except (ContainerError, OSError):
+        pass  # Not MP4/MKV, or a damaged header: let the decoders try
+    if metadata is None and shutil.which(FFPROBE):
+        try:
+            metadata = _probe_ffprobe(video_path)
+        except (OSError, subprocess.SubprocessError, ValueError) as e:
+            print(f"ffprobe failed for {video_path}, falling back to OpenCV: {e}")
+    if metadata is None:
+        metadata = _probe_cv2(video_path) or dict.fromkeys(
+            ('duration', 'width', 'height', 'fps', 'video_codec', 'audio_codec', 'bitrate', 'container')
+        )
+
+    metadata['file_size'] = os.path.getsize(video_path)
+    if not metadata['bitrate'] and metadata['duration']:
+        metadata['bitrate'] = int(metadata['file_size'] * 8 / metadata['duration'])
+    return metadata
+
+
+def is_video_header(header):
+    """True if the first bytes of a file (container.SNIFF_SIZE) are a supported video container"""
+    return sniff_container(header) is not None
+
+
+def validate_video(video_path):
+    """Cheap check that an upload really is a video.
+
+    A parsable MP4/MKV header with a video track is enough; the OpenCV
+    decoder is only opened for other containers or damaged headers.
+    """
+    try:
+        if read_container_info(video_path)['video_codec']:
+            return True
+    except (ContainerError, OSError):
+        pass
+    cap = cv2.VideoCapture(video_path)
+    try:
+        return cap.isOpened() and cap.grab()
+    finally:
+        cap.release()
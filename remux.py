@@ -0,0 +1,150 @@
+"""On-the-fly fragmented-MP4 remux for containers browsers can't play.
+
+MKV/AVI/FLV uploads often hold H.264 (or VP9/AV1) that a browser could
+decode, just not in that container. The first viewer starts ffmpeg
+rewrapping the video stream into fragmented MP4 by stream copy, written
+to a part file in the cache folder; every viewer is sent that file as it
+grows. Each finished remux is kept in a small LRU disk cache, so repeat
+viewers get a plain file with range requests (and so seeking) instead
+of another ffmpeg run.
+"""
+import os
+import subprocess
+import threading
+import time
+
+from thumbnails import FFMPEG
+
+BROWSER_VIDEO_CODECS = {'h264', 'vp9', 'av1'}
+# Copied as they are; anything else (or unknown) is re-encoded to AAC, which is cheap
+BROWSER_AUDIO_CODECS = {'aac', 'mp3', 'opus', 'flac'}
+READ_SIZE = 64 * 1024
+POLL_SECONDS = 0.2
+# A part file that hasn't grown for this long belongs to a remux that died
+STALL_SECONDS = 60
+
+
+def can_remux(video_codec):
+    return video_codec in BROWSER_VIDEO_CODECS
+
+
+def fmp4_command(video_path, audio_codec):
+    audio = ['-c:a', 'copy'] if audio_codec in BROWSER_AUDIO_CODECS else ['-c:a', 'aac', '-b:a', '160k', '-ac', '2']
+    return [
+        FFMPEG, '-v', 'error', '-nostdin', '-i', video_path,
+        '-map', '0:v:0', '-map', '0:a:0?', '-c:v', 'copy', *audio, '-sn', '-dn',
+        # Moov up front, then self-contained fragments: playable while still being written
+        '-movflags', 'frag_keyframe+empty_moov+default_base_moof',
+        # A pipe is never seeked, so the file is only ever appended to
+        '-f', 'mp4', 'pipe:1',
+    ]
+
+
+class RemuxCache:
+    """Finished remuxes in a folder, evicted least recently used beyond max_bytes"""
+
+    def __init__(self, folder, max_bytes):
+        self.folder = folder
+        self.max_bytes = max_bytes
+        os.makedirs(folder, exist_ok=True)
+
+    def path(self, name):
+        return os.path.join(self.folder, name)
+
+    def get(self, name):
+        """Path of a cached remux, marked as just used, or None"""
+        path = self.path(name)
+        try:
+            os.utime(path)
+        except FileNotFoundError:
+            return None
+        return path
+
+    def add(self, temp_path, name):
+        """Keep a finished remux, unless it alone is larger than the whole cache"""
+        if os.path.getsize(temp_path) > self.max_bytes:
+            # It would only evict everything else and then itself
+            os.remove(temp_path)
+            return
+        os.replace(temp_path, self.path(name))
+        self.evict(keep=name)
+
+    def evict(self, keep=None):
+        entries = []
+        for entry in os.scandir(self.folder):
+            if entry.is_file() and not entry.name.endswith('.part'):
+                stat = entry.stat()
+                entries.append((stat.st_mtime, stat.st_size, entry.path, entry.name))
+        total = sum(size for _, size, _, _ in entries)
+        for _, size, path, name in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            if name == keep:
+                continue
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass  # Evicted concurrently
+            total -= size
+
+    def stream(self, video_path, name, audio_codec):
+        """Fragmented MP4 of video_path as ffmpeg produces it, in READ_SIZE pieces.
+
+        ffmpeg writes `<name>.part` at disk speed, whatever the viewers
+        do, and the finished file becomes the cache entry. Every viewer
+        (later ones too, while it runs) follows that file, so memory stays
+        bounded, and a slow client or one that goes away never stalls the
+        remux or stops it from being cached.
+        """
+        part_path = self.path(f'{name}.part')
+        for _ in range(2):
+            self._start(video_path, part_path, name, audio_codec)
+            # The remux may finish (or fail) between starting and opening
+            for path in (part_path, self.path(name)):
+                try:
+                    return self._follow(open(path, 'rb'), part_path)
+                except FileNotFoundError:
+                    pass
+        raise FileNotFoundError(part_path)
+
+    def _start(self, video_path, part_path, name, audio_codec):
+        """Start ffmpeg writing part_path, unless the remux is running or done"""
+        if os.path.exists(self.path(name)):
+            return
+        try:
+            fd = os.open(part_path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o644)
+        except FileExistsError:
+            try:
+                if time.time() - os.path.getmtime(part_path) < STALL_SECONDS:
+                    return
+                os.remove(part_path)  # Left by a remux whose process died
+            except FileNotFoundError:
+                pass
+            return self._start(video_path, part_path, name, audio_codec)
+        with os.fdopen(fd, 'wb') as out:
+            proc = subprocess.Popen(fmp4_command(video_path, audio_codec), stdout=out, stderr=subprocess.DEVNULL)
+        threading.Thread(target=self._finish, args=(proc, part_path, name), daemon=True).start()
+
+    def _finish(self, proc, part_path, name):
+        if proc.wait() == 0:
+            self.add(part_path, name)
+        elif os.path.exists(part_path):
+            os.remove(part_path)
+
+    def _follow(self, f, part_path):
+        # Read until the part file is gone (cached or removed) and drained;
+        # the open file keeps reading the same data after the rename
+        with f:
+            grew_at = time.monotonic()
+            while True:
+                data = f.read(READ_SIZE)
+                if data:
+                    grew_at = time.monotonic()
+                    yield data
+                elif not os.path.exists(part_path):
+                    yield from iter(lambda: f.read(READ_SIZE), b'')
+                    return
+                elif time.monotonic() - grew_at > STALL_SECONDS:
+                    return
+                else:
+                    time.sleep(POLL_SECONDS)
@@ -0,0 +1,166 @@
+import os
+import time
+import uuid
+
+import sqlite_file
+
+WRITE_BUFFER_SIZE = 1024 * 1024
+
+
+class UploadError(Exception):
+    """Raised for a chunk that does not fit its upload, or finishing an incomplete upload"""
+
+
+class UploadRejected(UploadError):
+    """Raised when the first chunk shows the file is not something we accept"""
+
+
+class UploadSessions:
+    """Resumable chunked uploads tracked in a SQLite file shared between processes.
+
+    Each upload is split into fixed-size chunks that may arrive in any
+    order and in parallel. Every chunk is written at its offset directly
+    into the upload's part file, so nothing is spooled or copied, and the
+    chunks received so far are recorded so a client can ask where to
+    resume after a dropped connection. `accept_header` is called with the
+    start of the first chunk before anything is written, so a file of
+    the wrong type is turned away after one chunk.
+    """
+
+    def __init__(self, path, folder, chunk_size=8 * 1024 * 1024, expiry=86400, accept_header=None):
+        self.path = path
+        self.folder = folder
+        self.chunk_size = chunk_size
+        self.expiry = expiry
+        self.accept_header = accept_header
+        os.makedirs(folder, exist_ok=True)
+        with sqlite_file.create(self.path) as conn:
+            conn.execute('''
+                CREATE TABLE IF NOT EXISTS upload (
+                    id TEXT PRIMARY KEY,
+                    filename TEXT NOT NULL,
+                    extension TEXT NOT NULL,
+                    size INTEGER NOT NULL,
+                    chunk_size INTEGER NOT NULL,
+                    title TEXT,
+                    category_id INTEGER,
+                    batch_id TEXT,
+                    created_at REAL NOT NULL,
+                    updated_at REAL NOT NULL
+                )
+            ''')
+            conn.execute('''
+                CREATE TABLE IF NOT EXISTS upload_chunk (
+                    upload_id TEXT NOT NULL,
+                    offset INTEGER NOT NULL,
+                    PRIMARY KEY (upload_id, offset)
+                )
+            ''')
+            columns = {row[1] for row in conn.execute('PRAGMA table_info(upload)')}
+            if 'batch_id' not in columns:
+                conn.execute('ALTER TABLE upload ADD COLUMN batch_id TEXT')
+
+    def _connect(self):
+        return sqlite_file.connect(self.path)
+
+    def part_path(self, upload_id):
+        return os.path.join(self.folder, f'{upload_id}.part')
+
+    def create(self, filename, extension, size, title=None, category_id=None, batch_id=None):
+        """Start an upload of `size` bytes and return its status"""
+        self.expire()
+        upload_id = uuid.uuid4().hex
+        now = time.time()
+        open(self.part_path(upload_id), 'wb').close()
+        with self._connect() as conn:
+            conn.execute(
+                'INSERT INTO upload (id, filename, extension, size, chunk_size, title, category_id, batch_id, '
+                'created_at, updated_at) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                (upload_id, filename, extension, size, self.chunk_size, title, category_id, batch_id, now, now)
+            )
+        return self.status(upload_id)
+
+    def status(self, upload_id):
+        """The upload's fields plus `offset` (bytes received without a gap) and the `missing` chunk offsets"""
+        with self._connect() as conn:
+            row = conn.execute(
+                'SELECT id, filename, extension, size, chunk_size, title, category_id, batch_id FROM upload WHERE id = ?',
+                (upload_id,)
+            ).fetchone()
+            if row is None:
+                return None
+            received = {r[0] for r in conn.execute(
+                'SELECT offset FROM upload_chunk WHERE upload_id = ?', (upload_id,)
+            )}
+        upload = dict(zip(('id', 'filename', 'extension', 'size', 'chunk_size', 'title', 'category_id', 'batch_id'), row))
+        missing = [offset for offset in range(0, upload['size'], upload['chunk_size']) if offset not in received]
+        upload['missing'] = missing
+        upload['offset'] = missing[0] if missing else upload['size']
+        return upload
+
+    def write_chunk(self, upload_id, offset, stream, length):
+        """Copy one chunk from a file-like `stream` into place; returns the new status"""
+        upload = self.status(upload_id)
+        if upload is None:
+            raise KeyError(upload_id)
+        if offset < 0 or offset >= upload['size'] or offset % upload['chunk_size']:
+            raise UploadError(f'offset {offset} is not a chunk boundary of this upload')
+        expected = min(upload['chunk_size'], upload['size'] - offset)
+        if length != expected:
+            raise UploadError(f'chunk at {offset} must be {expected} bytes, got {length}')
+
+        fd = os.open(self.part_path(upload_id), os.O_WRONLY)
+        try:
+            position, remaining = offset, length
+            while remaining:
+                data = stream.read(min(WRITE_BUFFER_SIZE, remaining))
+                if not data:
+                    raise UploadError(f'chunk at {offset} ended after {length - remaining} bytes')
+                if position == 0 and self.accept_header and not self.accept_header(data):
+                    raise UploadRejected('unrecognised file type')
+                os.pwrite(fd, data, position)
+                position += len(data)
+                remaining -= len(data)
+        finally:
+            os.close(fd)
+
+        # Only recorded once every byte is on disk, so a dropped
+        # connection just leaves the chunk missing
+        with self._connect() as conn:
+            conn.execute('INSERT OR IGNORE INTO upload_chunk (upload_id, offset) VALUES (?, ?)', (upload_id, offset))
+            conn.execute('UPDATE upload SET updated_at = ? WHERE id = ?', (time.time(), upload_id))
+        return self.status(upload_id)
+
+    def finish(self, upload_id):
+        """Forget a complete upload and return its status; the caller takes over the part file"""
+        upload = self.status(upload_id)
+        if upload is None:
+            raise KeyError(upload_id)
+        if upload['missing']:
+            raise UploadError(f"{len(upload['missing'])} chunks are still missing")
+        if not self._forget(upload_id):
+            raise KeyError(upload_id)  # Finished concurrently by another request
+        return upload
+
+    def abort(self, upload_id):
+        self._forget(upload_id)
+        if os.path.exists(self.part_path(upload_id)):
+            os.remove(self.part_path(upload_id))
+
+    def expire(self):
+        """Abort uploads that have not received a chunk for `expiry` seconds"""
+        with self._connect() as conn:
+            stale = [r[0] for r in conn.execute(
+                'SELECT id FROM upload WHERE updated_at < ?', (time.time() - self.expiry,)
+            )]
+        for upload_id in stale:
+            self.abort(upload_id)
+        return len(stale)
+
+    def _forget(self, upload_id):
+        with self._connect() as conn:
+            conn.execute('BEGIN IMMEDIATE')
+            conn.execute('DELETE FROM upload_chunk WHERE upload_id = ?', (upload_id,))
+            deleted = conn.execute('DELETE FROM upload WHERE id = ?', (upload_id,)).rowcount
+            conn.execute('COMMIT')
+        return deleted
@@ -0,0 +1,131 @@
+import math
+import shutil
+import subprocess
+
+import cv2
+import numpy as np
+
+from thumbnails import FFMPEG, video_duration
+
+
+def _frame_size(video_path, tile_width, source_size=None):
+    if source_size and all(source_size):
+        width, height = source_size
+    else:
+        cap = cv2.VideoCapture(video_path)
+        try:
+            width = cap.get(cv2.CAP_PROP_FRAME_WIDTH)
+            height = cap.get(cv2.CAP_PROP_FRAME_HEIGHT)
+        finally:
+            cap.release()
+    if not width or not height:
+        return tile_width, round(tile_width * 9 / 16)
+    # Even height keeps ffmpeg's scaler happy with yuv420 sources
+    return tile_width, max(2, int(round(height * tile_width / width / 2)) * 2)
+
+
+def _frames_ffmpeg(video_path, interval, size, max_frames):
+    # One decode pass: the fps filter drops everything between samples and
+    # frames arrive already scaled as raw BGR, so nothing is re-encoded
+    width, height = size
+    frame_bytes = width * height * 3
+    cmd = [FFMPEG, '-v', 'error', '-nostdin', '-i', video_path, '-an', '-sn',
+           '-vf', f'fps=1/{interval},scale={width}:{height}',
+           '-frames:v', str(max_frames), '-f', 'rawvideo', '-pix_fmt', 'bgr24', 'pipe:1']
+    proc = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+    frames = []
+    try:
+        while True:
+            data = proc.stdout.read(frame_bytes)
+            if len(data) < frame_bytes:
+                break
+            frames.append(np.frombuffer(data, dtype=np.uint8).reshape(height, width, 3))
+    finally:
+        proc.stdout.close()
+        proc.wait()
+    return frames
+
+
+def _frames_cv2(video_path, interval, size, max_frames):
+    # Sequential grab() advances without converting frames we don't keep
+    cap = cv2.VideoCapture(video_path)
+    frames = []
+    next_time = 0.0
+    try:
+        while len(frames) < max_frames and cap.grab():
+            position = cap.get(cv2.CAP_PROP_POS_MSEC) / 1000
+            if position + 1e-3 < next_time:
+                continue
+            ret, frame = cap.retrieve()
+            if not ret:
+                break
+            frames.append(cv2.resize(frame, size, interpolation=cv2.INTER_AREA))
+            next_time += interval
+    finally:
+        cap.release()
+    return frames
+
+
+def _timestamp(seconds):
+    hours, rest = divmod(seconds, 3600)
+    minutes, seconds = divmod(rest, 60)
+    return f'{int(hours):02d}:{int(minutes):02d}:{seconds:06.3f}'
+
+
+def generate_sprite_sheet(video_path, store, interval=10.0, tile_width=160, columns=10,
+                          max_frames=100, quality=70, duration=None, source_size=None):
+    """Decode a video once into a tiled JPEG sprite sheet plus a WebVTT index.
+
+    One tile is taken every `interval` seconds; long videos stretch the
+    interval so the sheet never holds more than `max_frames` tiles. Each
+    VTT cue maps a time range to `sprite.jpg#xywh=x,y,w,h`. Both files go
+    into `store` (a store.ContentStore); returns (sprite_key, vtt_key), or
+    None if nothing could be decoded.
+    Pass the probed `duration` and `source_size` (width, height) to avoid
+    reopening the file for them.
+    """
+    try:
+        duration = duration or video_duration(video_path)
+        if duration:
+            interval = max(interval, duration / max_frames)
+        size = _frame_size(video_path, tile_width, source_size)
+
+        frames = []
+        if shutil.which(FFMPEG):
+            frames = _frames_ffmpeg(video_path, interval, size, max_frames)
+        if not frames:
+            frames = _frames_cv2(video_path, interval, size, max_frames)
+        if not frames:
+            return None
+
+        tile_w, tile_h = size
+        columns = min(columns, len(frames))
+        rows = math.ceil(len(frames) / columns)
+        sheet = np.zeros((rows * tile_h, columns * tile_w, 3), dtype=np.uint8)
+        for index, frame in enumerate(frames):
+            row, column = divmod(index, columns)
+            sheet[row * tile_h:(row + 1) * tile_h, column * tile_w:(column + 1) * tile_w] = frame
+
+        ok, encoded = cv2.imencode('.jpg', sheet, [cv2.IMWRITE_JPEG_QUALITY, quality])
+        if not ok:
+            raise ValueError('Could not encode sprite sheet')
+        sprite_key = store.put_bytes(encoded.tobytes(), 'jpg')
+        # Store keys are <aa>/<bb>/<hash>.<ext>, so the sheet is two
+        # directories up from wherever the VTT file itself lands
+        sprite_ref = f'../../{sprite_key}'
+
+        end_of_video = duration or len(frames) * interval
+        cues = ['WEBVTT', '']
+        for index in range(len(frames)):
+            row, column = divmod(index, columns)
+            start = index * interval
+            end = min((index + 1) * interval, end_of_video) if index < len(frames) - 1 else end_of_video
+            cues.append(f'{_timestamp(start)} --> {_timestamp(max(end, start + 0.001))}')
+            cues.append(f'{sprite_ref}#xywh={column * tile_w},{row * tile_h},{tile_w},{tile_h}')
+            cues.append('')
+        vtt_key = store.put_bytes('\n'.join(cues).encode('utf-8'), 'vtt')
+
+        return sprite_key, vtt_key
+    except Exception as e:
+        print(f"Error generating sprite sheet: {e}")
+        return None
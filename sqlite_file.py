@@ -0,0 +1,28 @@
+"""Connections to the small SQLite files in instance/ (job queue, store
+indexes, upload sessions, caches, the watcher's ledger).
+
+Every process (gunicorn workers, the job worker, the watcher) opens them
+per operation. Files are in WAL mode so readers don't wait on a writer.
+"""
+import os
+import sqlite3
+from contextlib import contextmanager
+
+
+@contextmanager
+def connect(path):
+    # Autocommit mode; multi-statement work uses explicit BEGIN/COMMIT
+    conn = sqlite3.connect(path, timeout=30, isolation_level=None)
+    try:
+        yield conn
+    finally:
+        conn.close()
+
+
+@contextmanager
+def create(path):
+    """Connect for setting up the schema, creating the file (and its folder) in WAL mode"""
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    with connect(path) as conn:
+        conn.execute('PRAGMA journal_mode=WAL')
+        yield conn
@@ -18,15 +18,263 @@ document.addEventListener('DOMContentLoaded', function() {
             if (file) {
                 const fileSize = (file.size / 1024 / 1024).toFixed(2);
                 console.log('Selected file: ' + file.name + ' (' + fileSize + ' MB)');
-                
-                if (fileSize > 500) {
-                    alert('File size exceeds 500MB limit!');
-                    fileInput.value = '';
+            }
+        });
+    }
+
+    // Resumable chunked uploads: chunks go up in parallel, each retried on
+    // its own, and an interrupted upload picks up where it stopped (the
+    // upload id is remembered per file in localStorage)
+    const CHUNK_PARALLELISM = 4;
+    const CHUNK_RETRIES = 5;
+
+    function sleep(ms) {
+        return new Promise(resolve => setTimeout(resolve, ms));
+    }
+
+    async function putChunk(uploadUrl, file, offset, chunkSize) {
+        const blob = file.slice(offset, Math.min(offset + chunkSize, file.size));
+        for (let attempt = 1; ; attempt++) {
+            let response = null;
+            try {
+                response = await fetch(uploadUrl + '?offset=' + offset, { method: 'PUT', body: blob });
+            } catch (err) {
+                // Network error: retry below
+            }
+            if (response && response.ok) {
+                return blob.size;
+            }
+            if (response && response.status < 500) {
+                throw new Error((await response.json()).error || response.statusText);
+            }
+            if (attempt >= CHUNK_RETRIES) {
+                throw new Error('Chunk at ' + offset + ' failed after ' + attempt + ' attempts');
+            }
+            await sleep(500 * 2 ** attempt);
+        }
+    }
+
+    function resumeKeyFor(file) {
+        return 'upload:' + file.name + ':' + file.size + ':' + file.lastModified;
+    }
+
+    async function openUpload(createUrl, fields, file) {
+        const resumeKey = resumeKeyFor(file);
+        const previous = localStorage.getItem(resumeKey);
+        if (previous) {
+            const response = await fetch(previous);
+            if (response.ok) {
+                return { url: previous, status: await response.json(), resumeKey };
+            }
+        }
+        const response = await fetch(createUrl, {
+            method: 'POST',
+            headers: { 'Content-Type': 'application/json' },
+            body: JSON.stringify(Object.assign({ size: file.size }, fields))
+        });
+        const status = await response.json();
+        if (!response.ok) {
+            throw new Error(status.error || response.statusText);
+        }
+        const url = response.headers.get('Location');
+        localStorage.setItem(resumeKey, url);
+        return { url, status, resumeKey };
+    }
+
+    // Hash in a Web Worker so the page stays responsive on multi-GB files
+    function hashFile(workerUrl, file, onProgress) {
+        return new Promise((resolve, reject) => {
+            const worker = new Worker(workerUrl);
+            worker.onmessage = function(e) {
+                if (e.data.digest) {
+                    worker.terminate();
+                    resolve(e.data.digest);
+                } else {
+                    onProgress(e.data.progress);
+                }
+            };
+            worker.onerror = function(e) {
+                worker.terminate();
+                reject(new Error(e.message));
+            };
+            worker.postMessage(file);
+        });
+    }
+
+    // Ask the server whether these bytes are already stored: if so the
+    // video is added without uploading anything
+    async function lookupUpload(lookupUrl, fields, digest) {
+        const response = await fetch(lookupUrl, {
+            method: 'POST',
+            headers: { 'Content-Type': 'application/json' },
+            body: JSON.stringify(Object.assign({ sha256: digest }, fields))
+        });
+        return response.status === 201;
+    }
+
+    async function chunkedUpload(createUrl, fields, file, onProgress) {
+        const upload = await openUpload(createUrl, fields, file);
+        const pending = upload.status.missing.slice();
+        const chunkSize = upload.status.chunk_size;
+        let sent = file.size - pending.reduce((total, offset) => total + Math.min(chunkSize, file.size - offset), 0);
+        onProgress(sent / file.size);
+
+        async function drain() {
+            while (pending.length) {
+                sent += await putChunk(upload.url, file, pending.shift(), chunkSize);
+                onProgress(sent / file.size);
+            }
+        }
+        await Promise.all(Array.from({ length: CHUNK_PARALLELISM }, drain));
+
+        const response = await fetch(upload.url + '/finalize', { method: 'POST' });
+        localStorage.removeItem(upload.resumeKey);
+        if (!response.ok) {
+            throw new Error((await response.json()).error || response.statusText);
+        }
+        return response.json();
+    }
+
+    async function uploadFile(form, file, fields, setLabel) {
+        // A half-finished upload means the server didn't have the file
+        if (window.Worker && form.dataset.hashWorker && !localStorage.getItem(resumeKeyFor(file))) {
+            const digest = await hashFile(form.dataset.hashWorker, file, fraction => {
+                setLabel('Checking ' + Math.floor(fraction * 100) + '%');
+            });
+            if (await lookupUpload(form.dataset.uploadLookup, fields, digest)) {
+                return;
+            }
+        }
+        await chunkedUpload(form.dataset.chunkedUpload, fields, file, fraction => {
+            setLabel('Uploading ' + Math.floor(fraction * 100) + '%');
+        });
+    }
+
+    async function createBatch(batchesUrl) {
+        const response = await fetch(batchesUrl, { method: 'POST' });
+        if (!response.ok) {
+            throw new Error(response.statusText);
+        }
+        return (await response.json()).id;
+    }
+
+    document.querySelectorAll('form[data-chunked-upload]').forEach(form => {
+        const fileInput = form.querySelector('input[type="file"]');
+        const folderToggle = form.querySelector('[data-folder-toggle]');
+        if (folderToggle) {
+            folderToggle.addEventListener('change', function() {
+                fileInput.webkitdirectory = folderToggle.checked;
+                fileInput.value = '';
+            });
+        }
+
+        form.addEventListener('submit', function(e) {
+            const extensions = (form.dataset.extensions || '').split(',');
+            const files = Array.from(fileInput.files).filter(file =>
+                extensions.includes(file.name.split('.').pop().toLowerCase()));
+            if (!files.length || !window.fetch || !files[0].slice) {
+                return;  // Plain multipart POST
+            }
+            e.preventDefault();
+            const submitBtn = form.querySelector('button[type="submit"]');
+            const title = form.querySelector('[name="video_title"]').value;
+            const categoryId = form.querySelector('[name="category_id"]').value;
+
+            // Files go up one at a time (each in parallel chunks); the
+            // server queues processing as each one lands, so nothing here
+            // waits for thumbnails
+            async function uploadAll() {
+                const batchId = files.length > 1 ? await createBatch(form.dataset.batches) : null;
+                const failures = [];
+                for (const [index, file] of files.entries()) {
+                    const prefix = files.length > 1 ? (index + 1) + '/' + files.length + ' ' : '';
+                    const fields = {
+                        filename: file.webkitRelativePath || file.name,
+                        video_title: files.length > 1 ? '' : title,
+                        category_id: categoryId,
+                        batch_id: batchId
+                    };
+                    try {
+                        await uploadFile(form, file, fields, label => {
+                            submitBtn.textContent = prefix + label;
+                        });
+                    } catch (err) {
+                        failures.push(file.name + ': ' + err.message);
+                    }
+                }
+                if (failures.length) {
+                    throw new Error(failures.join('\n'));
                 }
             }
+
+            uploadAll().then(() => {
+                window.location.reload();
+            }).catch(err => {
+                alert('Upload failed:\n' + err.message + '\nSubmit again to resume.');
+                submitBtn.disabled = false;
+                submitBtn.textContent = 'Upload Video';
+            });
         });
+    });
+
+    // Hover-scrub previews: map the cursor position to a tile in the
+    // video's sprite sheet using its WebVTT index
+    const spriteCues = {};
+
+    function parseVttTime(value) {
+        return value.trim().split(':').reduce((total, part) => total * 60 + parseFloat(part), 0);
     }
 
+    function loadSpriteCues(vttUrl) {
+        if (!spriteCues[vttUrl]) {
+            const base = new URL(vttUrl, window.location.href);
+            spriteCues[vttUrl] = fetch(vttUrl)
+                .then(response => response.text())
+                .then(text => text.split(/\n\s*\n/).map(block => {
+                    const lines = block.trim().split('\n');
+                    const timing = lines.findIndex(line => line.includes('-->'));
+                    if (timing === -1 || !lines[timing + 1]) {
+                        return null;
+                    }
+                    const [start, end] = lines[timing].split('-->').map(parseVttTime);
+                    const [file, xywh] = lines[timing + 1].trim().split('#xywh=');
+                    const [x, y, w, h] = xywh.split(',').map(Number);
+                    return { start, end, url: new URL(file, base).href, x, y, w, h };
+                }).filter(cue => cue !== null));
+        }
+        return spriteCues[vttUrl];
+    }
+
+    document.querySelectorAll('.thumbnail-container[data-sprite-vtt]').forEach(container => {
+        const preview = document.createElement('div');
+        preview.className = 'scrub-preview';
+        container.appendChild(preview);
+
+        container.addEventListener('mousemove', function(e) {
+            loadSpriteCues(container.dataset.spriteVtt).then(cues => {
+                if (!cues.length) {
+                    return;
+                }
+                const rect = container.getBoundingClientRect();
+                const fraction = Math.min(Math.max((e.clientX - rect.left) / rect.width, 0), 0.999);
+                const cue = cues[Math.floor(fraction * cues.length)];
+                const sheetWidth = Math.max(...cues.map(c => c.x + c.w));
+                const sheetHeight = Math.max(...cues.map(c => c.y + c.h));
+                const scale = rect.width / cue.w;
+
+                preview.style.backgroundImage = 'url("' + cue.url + '")';
+                preview.style.backgroundSize = (sheetWidth * scale) + 'px ' + (sheetHeight * scale) + 'px';
+                preview.style.backgroundPosition = (-cue.x * scale) + 'px ' + (-cue.y * scale) + 'px';
+                preview.style.height = (cue.h * scale) + 'px';
+                preview.classList.add('active');
+            });
+        });
+
+        container.addEventListener('mouseleave', function() {
+            preview.classList.remove('active');
+        });
+    });
+
     document.querySelectorAll('a[href^="#"]').forEach(anchor => {
         anchor.addEventListener('click', function (e) {
             e.preventDefault();
@@ -0,0 +1,270 @@
+import hashlib
+import os
+import uuid
+
+import sqlite_file
+
+HASH_CHUNK_SIZE = 1024 * 1024
+
+
+def hash_file(path):
+    """SHA-256 hex digest of a file, read in 1MB chunks"""
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(HASH_CHUNK_SIZE), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+class ContentRejected(Exception):
+    """Raised by IngestFile.finish() when the start of the content failed its header check"""
+
+
+class IngestFile:
+    """Writable file that hashes and sniffs its content as it is written.
+
+    Used as the destination of an upload so the bytes land on disk once,
+    already hashed for ContentStore.put_file(). `accept_header` is called
+    with the first `header_size` bytes as soon as they arrive; if it
+    returns False the file is deleted at once and the rest of the content
+    is discarded unwritten (other files in the same request body still go
+    through), and finish() raises ContentRejected. close() deletes the
+    file unless it has been moved away (e.g. into the store) first.
+    """
+
+    def __init__(self, path, accept_header=None, header_size=12):
+        self.path = path
+        self.accept_header = accept_header
+        self.header_size = header_size
+        self.header = b''
+        self.rejected = None
+        self.size = 0
+        self._sha256 = hashlib.sha256()
+        self._file = open(path, 'wb+')
+
+    def write(self, data):
+        if self.rejected:
+            return len(data)
+        if self.accept_header and len(self.header) < self.header_size:
+            self.header += data[:self.header_size - len(self.header)]
+            if len(self.header) == self.header_size:
+                self._check_header()
+                if self.rejected:
+                    return len(data)
+        self._sha256.update(data)
+        self.size += len(data)
+        return self._file.write(data)
+
+    def _check_header(self):
+        accept_header, self.accept_header = self.accept_header, None
+        if not accept_header(self.header):
+            self.rejected = f'unrecognised content header {self.header[:8]!r}'
+            self.close()
+
+    def finish(self):
+        """Flush to disk and return the SHA-256 hex digest; shorter-than-header files are checked here"""
+        if self.accept_header:
+            self._check_header()
+        if self.rejected:
+            raise ContentRejected(self.rejected)
+        self._file.close()
+        return self._sha256.hexdigest()
+
+    def seek(self, offset, whence=0):
+        # Werkzeug rewinds every file part once it is complete, rejected or not
+        return 0 if self.rejected else self._file.seek(offset, whence)
+
+    def close(self):
+        self._file.close()
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+    def __getattr__(self, name):
+        # seek(), read() etc. for code that treats this as a plain file
+        return getattr(self._file, name)
+
+
+class ContentStore:
+    """Content-addressed file store with reference counting.
+
+    Files live at <root>/<aa>/<bb>/<sha256>.<ext>, so a name always
+    identifies the same bytes: identical content is stored once,
+    concurrent writers can never clobber each other and served files can
+    be cached forever. Reference counts live in a small SQLite index and
+    a file is only unlinked when its last reference is released. Content
+    stored in a rewritten form (e.g. remuxed) keeps an alias from the hash
+    of the original bytes, so claim() still finds it by that hash.
+    """
+
+    def __init__(self, root, index_path):
+        self.root = root
+        self.index_path = index_path
+        self.tmp_folder = os.path.join(root, 'tmp')
+        os.makedirs(self.tmp_folder, exist_ok=True)
+        with sqlite_file.create(self.index_path) as conn:
+            conn.execute('CREATE TABLE IF NOT EXISTS object (key TEXT PRIMARY KEY, refs INTEGER NOT NULL)')
+            conn.execute('CREATE TABLE IF NOT EXISTS alias (digest TEXT PRIMARY KEY, key TEXT NOT NULL)')
+
+    def _connect(self):
+        return sqlite_file.connect(self.index_path)
+
+    @staticmethod
+    def key_for(digest, ext):
+        return f'{digest[:2]}/{digest[2:4]}/{digest}.{ext}'
+
+    @staticmethod
+    def digest_of(key):
+        """The content hash embedded in a key, or None for files from before the store"""
+        name = os.path.basename(key).split('.', 1)[0]
+        return name if len(name) == 64 and key.count('/') == 2 else None
+
+    def path(self, key):
+        return os.path.join(self.root, key)
+
+    def temp_path(self, suffix=''):
+        """A unique scratch path inside the store, on the same filesystem as its objects"""
+        return os.path.join(self.tmp_folder, f'{uuid.uuid4().hex}{suffix}')
+
+    def put_bytes(self, data, ext):
+        digest = hashlib.sha256(data).hexdigest()
+        tmp_path = self.temp_path()
+        with open(tmp_path, 'wb') as f:
+            f.write(data)
+        return self.put_file(tmp_path, ext, digest)
+
+    def put_file(self, src_path, ext, digest=None):
+        """Move src_path into the store and take a reference to it; returns its key.
+
+        If the content is already stored, src_path is discarded instead.
+        """
+        digest = digest or hash_file(src_path)
+        key = self.key_for(digest, ext)
+        final_path = self.path(key)
+        os.makedirs(os.path.dirname(final_path), exist_ok=True)
+        with self._connect() as conn:
+            # The write lock serialises placement against release() so a
+            # file can't be unlinked between the existence check and incref
+            conn.execute('BEGIN IMMEDIATE')
+            try:
+                if os.path.exists(final_path):
+                    os.remove(src_path)
+                else:
+                    os.replace(src_path, final_path)
+                conn.execute(
+                    'INSERT INTO object (key, refs) VALUES (?, 1) '
+                    'ON CONFLICT(key) DO UPDATE SET refs = refs + 1',
+                    (key,)
+                )
+                conn.execute('COMMIT')
+            except Exception:
+                conn.execute('ROLLBACK')
+                raise
+        return key
+
+    def claim(self, digest):
+        """Take a reference to already-stored content by its hash; returns the key or None"""
+        if len(digest) != 64 or not all(c in '0123456789abcdef' for c in digest):
+            return None
+        with self._connect() as conn:
+            # One transaction so a concurrent release() can't unlink the file in between
+            conn.execute('BEGIN IMMEDIATE')
+            try:
+                row = conn.execute(
+                    'SELECT key FROM object WHERE key LIKE ? AND refs > 0 LIMIT 1', (self.key_for(digest, '%'),)
+                ).fetchone() or conn.execute(
+                    'SELECT object.key FROM alias JOIN object ON object.key = alias.key '
+                    'WHERE alias.digest = ? AND object.refs > 0', (digest,)
+                ).fetchone()
+                if row is not None:
+                    conn.execute('UPDATE object SET refs = refs + 1 WHERE key = ?', (row[0],))
+                conn.execute('COMMIT')
+            except Exception:
+                conn.execute('ROLLBACK')
+                raise
+        return row[0] if row else None
+
+    def alias(self, digest, key):
+        """Make claim(digest) find `key`, whose content was derived from bytes hashing to `digest`"""
+        with self._connect() as conn:
+            conn.execute('INSERT OR REPLACE INTO alias (digest, key) VALUES (?, ?)', (digest, key))
+
+    def aliased(self, digest):
+        """The key an alias points `digest` at, if any"""
+        with self._connect() as conn:
+            row = conn.execute('SELECT key FROM alias WHERE digest = ?', (digest,)).fetchone()
+        return row[0] if row else None
+
+    def replace(self, old_key, src_path, ext, digest=None):
+        """Swap stored content for a rewritten version of it; returns the new key.
+
+        src_path is moved into the store and every reference to old_key is
+        carried over to it. The old file is unlinked, and its hash becomes
+        an alias of the new key.
+        """
+        digest = digest or hash_file(src_path)
+        key = self.key_for(digest, ext)
+        if key == old_key:
+            os.remove(src_path)
+            return key
+        final_path = self.path(key)
+        os.makedirs(os.path.dirname(final_path), exist_ok=True)
+        with self._connect() as conn:
+            conn.execute('BEGIN IMMEDIATE')
+            try:
+                row = conn.execute('SELECT refs FROM object WHERE key = ?', (old_key,)).fetchone()
+                if os.path.exists(final_path):
+                    os.remove(src_path)
+                else:
+                    os.replace(src_path, final_path)
+                conn.execute(
+                    'INSERT INTO object (key, refs) VALUES (?, ?) '
+                    'ON CONFLICT(key) DO UPDATE SET refs = refs + excluded.refs',
+                    (key, row[0] if row else 1)
+                )
+                conn.execute('DELETE FROM object WHERE key = ?', (old_key,))
+                conn.execute('UPDATE alias SET key = ? WHERE key = ?', (key, old_key))
+                old_digest = self.digest_of(old_key)
+                if old_digest:
+                    conn.execute('INSERT OR REPLACE INTO alias (digest, key) VALUES (?, ?)', (old_digest, key))
+                if os.path.exists(self.path(old_key)):
+                    os.remove(self.path(old_key))
+                conn.execute('COMMIT')
+            except Exception:
+                conn.execute('ROLLBACK')
+                raise
+        return key
+
+    def add_ref(self, key):
+        """Take another reference to an object that is already stored"""
+        with self._connect() as conn:
+            conn.execute(
+                'INSERT INTO object (key, refs) VALUES (?, 1) '
+                'ON CONFLICT(key) DO UPDATE SET refs = refs + 1',
+                (key,)
+            )
+
+    def release(self, key):
+        """Drop one reference; the file is unlinked with the last one.
+
+        Files written before the store existed have no index entry and
+        are unlinked straight away. Returns True if the file was removed.
+        """
+        with self._connect() as conn:
+            conn.execute('BEGIN IMMEDIATE')
+            try:
+                row = conn.execute('SELECT refs FROM object WHERE key = ?', (key,)).fetchone()
+                if row is not None and row[0] > 1:
+                    conn.execute('UPDATE object SET refs = refs - 1 WHERE key = ?', (key,))
+                    conn.execute('COMMIT')
+                    return False
+                conn.execute('DELETE FROM object WHERE key = ?', (key,))
+                conn.execute('DELETE FROM alias WHERE key = ?', (key,))
+                path = self.path(key)
+                removed = os.path.exists(path)
+                if removed:
+                    os.remove(path)
+                conn.execute('COMMIT')
+            except Exception:
+                conn.execute('ROLLBACK')
+                raise
+        return removed
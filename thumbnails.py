@@ -0,0 +1,432 @@
+import os
+import shutil
+from io import BytesIO
+import subprocess
+import threading
+import time
+from collections import deque
+from concurrent.futures import Future, ProcessPoolExecutor
+
+import cv2
+import numpy as np
+from PIL import Image
+
+from container import ContainerError, read_container_info
+from probe import probe_video
+
+try:
+    import pillow_avif  # noqa: F401 - registers the AVIF encoder with Pillow
+except ImportError:
+    pass
+
+FFMPEG = os.environ.get('FFMPEG_BINARY', 'ffmpeg')
+SEEK_MODES = ('keyframe', 'accurate', 'cv2')
+DEFAULT_WIDTHS = (320, 640, 1280)
+SCORE_SIZE = (160, 90)  # Frames are scored at this size, not at source resolution
+
+# Pillow save() arguments per output format, best compression first.
+# quality is the usual 0-100 scale; method (WebP, 0-6) and speed (AVIF,
+# 0-10, lower is slower) trade encode time for smaller files.
+DEFAULT_ENCODERS = {
+    'avif': {'quality': 60, 'speed': 6},
+    'webp': {'quality': 80, 'method': 4},
+    'jpeg': {'quality': 82, 'optimize': True, 'progressive': True},
+}
+FORMAT_EXTENSIONS = {'avif': 'avif', 'webp': 'webp', 'jpeg': 'jpg'}
+MIMETYPES = {'avif': 'image/avif', 'webp': 'image/webp', 'jpeg': 'image/jpeg'}
+
+
+def available_formats():
+    """Formats the installed Pillow can encode (AVIF needs pillow-avif-plugin)"""
+    Image.init()  # Pillow registers most encoders lazily
+    return [fmt for fmt in DEFAULT_ENCODERS if fmt.upper() in Image.SAVE]
+
+
+def negotiate_format(accept, formats):
+    """Pick the best of `formats` for a request's Accept header.
+
+    Browsers send image/avif and image/webp explicitly when they support
+    them, while */* is always present, so modern formats only count when
+    listed by name. JPEG is the universal fallback.
+    """
+    explicit = {value for value, quality in accept if quality > 0}
+    for fmt in ('avif', 'webp'):
+        if fmt in formats and MIMETYPES[fmt] in explicit:
+            return fmt
+    return 'jpeg'
+
+
+def _read_frame_ffmpeg(video_path, seconds, keyframe_only, size=None, timeout=60):
+    # -ss before -i seeks the demuxer by timestamp, so decoding starts at
+    # the keyframe preceding `seconds` instead of at the start of the file.
+    # In keyframe mode ffmpeg emits that keyframe itself (-noaccurate_seek)
+    # and the decoder skips every non-key frame, so nothing is decoded
+    # between the keyframe and the exact timestamp.
+    cmd = [FFMPEG, '-v', 'error', '-nostdin']
+    if keyframe_only:
+        cmd += ['-noaccurate_seek', '-skip_frame', 'nokey']
+    cmd += ['-ss', f'{seconds:.3f}', '-i', video_path, '-frames:v', '1', '-an', '-sn']
+    if size:
+        cmd += ['-vf', f'scale={size[0]}:{size[1]}']
+    cmd += ['-f', 'image2pipe', '-c:v', 'bmp', 'pipe:1']
+    result = subprocess.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, timeout=timeout)
+    if result.returncode != 0 or not result.stdout:
+        return None
+    return cv2.imdecode(np.frombuffer(result.stdout, dtype=np.uint8), cv2.IMREAD_COLOR)
+
+
+def _read_frame_cv2(video_path, seconds):
+    # Seek by timestamp rather than frame number: FPS metadata is often
+    # missing (fps == 0) in files that still decode fine
+    cap = cv2.VideoCapture(video_path)
+    try:
+        if seconds > 0:
+            cap.set(cv2.CAP_PROP_POS_MSEC, seconds * 1000)
+        ret, frame = cap.read()
+        if not ret and seconds > 0:
+            # Seek failed or went past the end; fall back to the first frame
+            cap.release()
+            cap = cv2.VideoCapture(video_path)
+            ret, frame = cap.read()
+        return frame if ret else None
+    finally:
+        cap.release()
+
+
+def read_frame(video_path, seconds, seek_mode='keyframe', size=None, timeout=60, deadline=None):
+    """Decode one frame near `seconds` as a BGR array, or return None.
+
+    'keyframe' and 'accurate' use ffmpeg input-side seeking when the
+    binary is available; 'cv2' (or a failed ffmpeg run) uses OpenCV.
+    `size` (width, height) scales the frame down as part of the decode.
+    With a `deadline` (time.monotonic()), ffmpeg gets the time left (at
+    least a second) and the OpenCV fallback, which can't be cut short,
+    is skipped once it has passed.
+    """
+    def time_left():
+        return timeout if deadline is None else max(deadline - time.monotonic(), 1)
+
+    if seek_mode != 'cv2' and shutil.which(FFMPEG):
+        keyframe_only = seek_mode == 'keyframe'
+        try:
+            frame = _read_frame_ffmpeg(video_path, seconds, keyframe_only, size, time_left())
+            if frame is None and seconds > 0:
+                # Clip shorter than the seek target
+                frame = _read_frame_ffmpeg(video_path, 0, keyframe_only, size, time_left())
+            if frame is not None:
+                return frame
+        except (OSError, subprocess.SubprocessError) as e:
+            print(f"ffmpeg seek failed for {video_path}, falling back to OpenCV: {e}")
+    if deadline is not None and time.monotonic() >= deadline:
+        return None
+    frame = _read_frame_cv2(video_path, seconds)
+    if frame is not None and size:
+        frame = cv2.resize(frame, size, interpolation=cv2.INTER_AREA)
+    return frame
+
+
+def video_duration(video_path):
+    """Duration in seconds from container metadata, or None when unknown"""
+    try:
+        duration = read_container_info(video_path)['duration']
+        if duration:
+            return duration
+    except (ContainerError, OSError):
+        pass
+    cap = cv2.VideoCapture(video_path)
+    try:
+        fps = cap.get(cv2.CAP_PROP_FPS)
+        frame_count = cap.get(cv2.CAP_PROP_FRAME_COUNT)
+    finally:
+        cap.release()
+    if fps > 0 and frame_count > 0:
+        return frame_count / fps
+    return None
+
+
+def score_frames(frames):
+    """Score a batch of equally sized BGR frames; higher is a better thumbnail.
+
+    Each frame is rated on sharpness (variance of the Laplacian), exposure
+    (distance of mean brightness from mid-grey) and detail (entropy of the
+    grey-level histogram), all computed across the whole batch at once.
+    """
+    gray = np.stack([cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY) for frame in frames])
+    count, pixels = gray.shape[0], gray.shape[1] * gray.shape[2]
+    g = gray.astype(np.float32)
+
+    # 4-neighbour Laplacian over the interior of every frame
+    laplacian = (g[:, :-2, 1:-1] + g[:, 2:, 1:-1] + g[:, 1:-1, :-2] + g[:, 1:-1, 2:]
+                 - 4 * g[:, 1:-1, 1:-1])
+    sharpness = laplacian.reshape(count, -1).var(axis=1)
+
+    brightness = g.reshape(count, -1).mean(axis=1)
+
+    # One bincount for the whole batch: offset each frame's grey levels
+    # into its own block of 256 bins
+    offsets = (np.arange(count) * 256)[:, None]
+    histograms = np.bincount((gray.reshape(count, -1) + offsets).ravel(),
+                             minlength=count * 256).reshape(count, 256)
+    p = histograms / pixels
+    entropy = -np.sum(p * np.log2(p, out=np.zeros_like(p), where=p > 0), axis=1)
+
+    sharpness_score = sharpness / (sharpness.max() + 1e-6)
+    exposure_score = np.clip(1 - np.abs(brightness - 118) / 118, 0, 1)
+    entropy_score = entropy / 8
+    scores = 0.4 * sharpness_score + 0.3 * exposure_score + 0.3 * entropy_score
+
+    # Black/white frames, fades and flat title cards are almost never wanted
+    scores[(brightness < 16) | (brightness > 240) | (entropy < 2)] *= 0.1
+    return scores
+
+
+def _sample_order(count):
+    # Coarse-to-fine visiting order (middle, quarters, eighths, ...) so a
+    # sampling run cut short by the budget still covers the whole video
+    order, step = [], count
+    while step >= 1:
+        for i in range(step // 2, count, step):
+            if i not in order:
+                order.append(i)
+        step //= 2
+    return order + [i for i in range(count) if i not in order]
+
+
+def pick_best_frame(video_path, samples=8, budget_seconds=5.0, seek_mode='keyframe', fallback_seconds=1.0,
+                    duration=None):
+    """Sample frames across the video and return the best scoring one at full resolution.
+
+    Every decode, the final full-resolution one included, counts against
+    `budget_seconds`, so the cost per video stays bounded whatever its
+    length. Returns None if nothing decodes.
+    """
+    deadline = time.monotonic() + budget_seconds
+    duration = duration or video_duration(video_path)
+    if not duration or samples <= 1:
+        return read_frame(video_path, fallback_seconds, seek_mode, deadline=deadline)
+
+    # Skip the first and last 5%, where intros, fades and credits live
+    timestamps = [duration * (0.05 + 0.9 * (i + 0.5) / samples) for i in range(samples)]
+    sampled, small_frames = [], []
+    slowest = 0.0
+    for index in _sample_order(samples):
+        # Another sample has to leave time for the full-size decode of the
+        # winner; each costs about as much as the slowest sample so far
+        if slowest and deadline - time.monotonic() <= 2 * slowest:
+            break
+        started = time.monotonic()
+        frame = read_frame(video_path, timestamps[index], seek_mode, SCORE_SIZE, deadline=deadline)
+        slowest = max(slowest, time.monotonic() - started)
+        if frame is not None:
+            sampled.append(timestamps[index])
+            small_frames.append(frame)
+
+    if not small_frames:
+        return read_frame(video_path, fallback_seconds, seek_mode, deadline=deadline)
+    best = int(np.argmax(score_frames(small_frames)))
+    frame = read_frame(video_path, sampled[best], seek_mode, deadline=deadline)
+    # Out of time for the full-size decode: a small thumbnail beats none
+    return frame if frame is not None else small_frames[best]
+
+
+def write_thumbnail_set(frame, store, widths=DEFAULT_WIDTHS, encoders=None):
+    """Store every width x format rendition of a single decoded BGR frame.
+
+    Widths larger than the frame collapse into one full-size variant, so
+    a small source never gets upscaled. `encoders` maps format name to
+    Pillow save() options; formats this Pillow cannot encode are skipped
+    and JPEG is always written. Each rendition goes into `store` (a
+    store.ContentStore); returns a list of variant dicts (width, height,
+    format, path) ordered by width, where path is the store key.
+    """
+    encoders = dict(encoders or DEFAULT_ENCODERS)
+    encoders.setdefault('jpeg', DEFAULT_ENCODERS['jpeg'])
+    supported = available_formats()
+    source_height, source_width = frame.shape[:2]
+
+    variants = []
+    for width in sorted({min(w, source_width) for w in widths}):
+        height = max(1, round(source_height * width / source_width))
+        if width == source_width:
+            resized = frame
+        else:
+            # INTER_AREA averages source pixels, which avoids aliasing when shrinking
+            resized = cv2.resize(frame, (width, height), interpolation=cv2.INTER_AREA)
+        image = Image.fromarray(cv2.cvtColor(resized, cv2.COLOR_BGR2RGB))
+        for fmt, options in encoders.items():
+            if fmt not in supported:
+                continue
+            buffer = BytesIO()
+            image.save(buffer, fmt.upper(), **options)
+            key = store.put_bytes(buffer.getvalue(), FORMAT_EXTENSIONS[fmt])
+            variants.append({'width': width, 'height': height, 'format': fmt, 'path': key})
+    return variants
+
+
+def default_variant(variants, target_width=640):
+    """JPEG variant used as the plain `src` when srcset is not available"""
+    jpegs = [variant for variant in variants if variant['format'] == 'jpeg']
+    for variant in jpegs:
+        if variant['width'] >= target_width:
+            return variant
+    return jpegs[-1]
+
+
+def generate_video_thumbnail(video_path, store, seek_mode='keyframe', seek_seconds=1.0,
+                             widths=DEFAULT_WIDTHS, encoders=None, samples=8, budget_seconds=5.0,
+                             duration=None):
+    """Generate the thumbnail set for an uploaded video (see write_thumbnail_set).
+
+    With samples > 1 the best of several frames is used (pick_best_frame);
+    otherwise the frame at `seek_seconds`.
+    """
+    try:
+        if samples > 1:
+            frame = pick_best_frame(video_path, samples, budget_seconds, seek_mode, seek_seconds, duration)
+        else:
+            frame = read_frame(video_path, seek_seconds, seek_mode)
+
+        if frame is not None:
+            return write_thumbnail_set(frame, store, widths, encoders)
+        return None
+    except Exception as e:
+        print(f"Error generating thumbnail: {e}")
+        return None
+
+
+def probe_and_generate_thumbnail(video_path, store, **options):
+    """Probe technical metadata and build the thumbnail set in one pool task.
+
+    The probed duration drives frame sampling, so the file's header is
+    only read once. Returns {'metadata': ..., 'variants': ...}, or None
+    when no thumbnail could be produced.
+    """
+    metadata = probe_video(video_path)
+    variants = generate_video_thumbnail(video_path, store, duration=metadata['duration'], **options)
+    if not variants:
+        return None
+    return {'metadata': metadata, 'variants': variants}
+
+
+def _timed_call(fn, *args, **kwargs):
+    # Runs in the pool process; timing here excludes time spent queued
+    started = time.perf_counter()
+    result = fn(*args, **kwargs)
+    return result, time.perf_counter() - started
+
+
+class EngineBusy(Exception):
+    """Raised when both the decode slots and the wait queue are full"""
+
+
+class ThumbnailEngine:
+    """Bounded process pool for decode work (thumbnails, sprite sheets).
+
+    At most ``max_in_flight`` decodes run at once and at most ``max_queued``
+    more wait for a slot; anything beyond that is rejected with EngineBusy
+    so a load spike turns into back-pressure instead of memory growth.
+    """
+
+    def __init__(self, workers=None, max_in_flight=None, max_queued=None, latency_window=500):
+        self.workers = workers or os.cpu_count() or 1
+        self.max_in_flight = max_in_flight or self.workers
+        self.max_queued = self.max_in_flight * 2 if max_queued is None else max_queued
+        self._pool = ProcessPoolExecutor(max_workers=self.workers)
+        # Fork the pool processes now, before callers start their own threads
+        self._pool.submit(os.getpid).result()
+        self._lock = threading.Lock()
+        self._waiting = deque()
+        self._in_flight = 0
+        self._decode_latency = deque(maxlen=latency_window)
+        self._total_latency = deque(maxlen=latency_window)
+        self._completed = 0
+        self._failed = 0
+        self._rejected = 0
+
+    def submit(self, fn, *args, **kwargs):
+        """Queue fn(*args, **kwargs) on the pool; returns a Future for its result.
+
+        `fn` must be a module-level function so it can be pickled, and
+        should return a falsy value on failure.
+        """
+        future = Future()
+        item = (fn, args, kwargs, future, time.perf_counter())
+        with self._lock:
+            if self._in_flight < self.max_in_flight:
+                self._in_flight += 1
+            elif len(self._waiting) < self.max_queued:
+                self._waiting.append(item)
+                return future
+            else:
+                self._rejected += 1
+                raise EngineBusy(f'{self._in_flight} decoding, {len(self._waiting)} queued')
+        self._dispatch(item)
+        return future
+
+    def run(self, fn, *args, **kwargs):
+        """Blocking helper around submit()"""
+        return self.submit(fn, *args, **kwargs).result()
+
+    def _dispatch(self, item):
+        fn, args, kwargs, future, queued_at = item
+        try:
+            pool_future = self._pool.submit(_timed_call, fn, *args, **kwargs)
+        except Exception as e:
+            self._finish(future, queued_at, error=e)
+            return
+        pool_future.add_done_callback(lambda f: self._on_done(f, future, queued_at))
+
+    def _on_done(self, pool_future, future, queued_at):
+        try:
+            result, decode_seconds = pool_future.result()
+        except Exception as e:
+            self._finish(future, queued_at, error=e)
+        else:
+            self._finish(future, queued_at, result=result, decode_seconds=decode_seconds)
+
+    def _finish(self, future, queued_at, result=None, decode_seconds=None, error=None):
+        with self._lock:
+            self._total_latency.append(time.perf_counter() - queued_at)
+            if decode_seconds is not None:
+                self._decode_latency.append(decode_seconds)
+            if error is None and result:
+                self._completed += 1
+            else:
+                self._failed += 1
+            # Hand the freed slot straight to the next waiter
+            next_item = self._waiting.popleft() if self._waiting else None
+            if next_item is None:
+                self._in_flight -= 1
+        if error is not None:
+            future.set_exception(error)
+        else:
+            future.set_result(result)
+        if next_item is not None:
+            self._dispatch(next_item)
+
+    def metrics(self):
+        with self._lock:
+            return {
+                'workers': self.workers,
+                'max_in_flight': self.max_in_flight,
+                'max_queued': self.max_queued,
+                'in_flight': self._in_flight,
+                'queue_depth': len(self._waiting),
+                'completed': self._completed,
+                'failed': self._failed,
+                'rejected': self._rejected,
+                'decode_latency': _percentiles(self._decode_latency),
+                'total_latency': _percentiles(self._total_latency),
+            }
+
+    def shutdown(self, wait=True):
+        self._pool.shutdown(wait=wait)
+
+
+def _percentiles(samples):
+    if not samples:
+        return {'p50': None, 'p95': None, 'max': None}
+    ordered = sorted(samples)
+    def pick(q):
+        return round(ordered[min(len(ordered) - 1, int(q * len(ordered)))], 4)
+    return {'p50': pick(0.5), 'p95': pick(0.95), 'max': round(ordered[-1], 4)}
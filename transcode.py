@@ -0,0 +1,265 @@
+import fcntl
+import json
+import math
+import os
+import shutil
+import subprocess
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+from thumbnails import FFMPEG
+
+# (height, video kbit/s, audio kbit/s), highest first
+HLS_LADDER = [
+    (2160, 14000, 192),
+    (1440, 8000, 192),
+    (1080, 5000, 128),
+    (720, 2800, 128),
+    (480, 1400, 96),
+    (360, 800, 96),
+    (240, 400, 64),
+]
+MASTER_PLAYLIST = 'master.m3u8'
+MANIFEST = 'chunks.json'
+
+
+def hls_key(video_key):
+    """Store-relative path of the master playlist for an upload: next to it, as <name>.hls/"""
+    return f'{os.path.splitext(video_key)[0]}.hls/{MASTER_PLAYLIST}'
+
+
+def remove_hls(upload_folder, video_key):
+    out_dir = os.path.join(upload_folder, os.path.dirname(hls_key(video_key)))
+    shutil.rmtree(out_dir, ignore_errors=True)
+    # Checkpoints of a segmented transcode that never finished
+    shutil.rmtree(f'{out_dir}.work', ignore_errors=True)
+
+
+def select_ladder(source_height, heights):
+    """The configured rungs a source can fill without upscaling (at least the smallest one)"""
+    rungs = [rung for rung in HLS_LADDER if rung[0] in heights]
+    fitting = [rung for rung in rungs if not source_height or rung[0] <= source_height]
+    if fitting:
+        return fitting
+    smallest = rungs[-1] if rungs else HLS_LADDER[-1]
+    # Tiny source: one rendition at its own (even) height
+    return [(max(2, source_height // 2 * 2), smallest[1], smallest[2])]
+
+
+def _scale_filter(rungs):
+    splits = ''.join(f'[v{i}]' for i in range(len(rungs)))
+    scales = ';'.join(f'[v{i}]scale=-2:{height}[v{i}out]' for i, (height, _, _) in enumerate(rungs))
+    return f'[0:v]split={len(rungs)}{splits};{scales}'
+
+
+def _video_rate_args(i, video_kbps):
+    return [f'-b:v:{i}', f'{video_kbps}k', f'-maxrate:v:{i}', f'{int(video_kbps * 1.07)}k',
+            f'-bufsize:v:{i}', f'{int(video_kbps * 1.5)}k']
+
+
+def _encoder_args(preset, segment_seconds, threads):
+    return [
+        '-preset', preset, '-pix_fmt', 'yuv420p', '-threads', str(threads),
+        # Keyframes on the same timestamps in every rendition, so players
+        # can switch rungs at any segment boundary
+        '-force_key_frames', f'expr:gte(t,n_forced*{segment_seconds})', '-sc_threshold', '0',
+    ]
+
+
+def _hls_output_args(out_dir, rungs, has_audio, segment_seconds):
+    streams = ' '.join(f'v:{i},a:{i}' if has_audio else f'v:{i}' for i in range(len(rungs)))
+    return [
+        '-f', 'hls', '-hls_time', str(segment_seconds), '-hls_playlist_type', 'vod',
+        '-hls_flags', 'independent_segments', '-master_pl_name', MASTER_PLAYLIST,
+        '-hls_segment_filename', os.path.join(out_dir, 'v%v', 'segment_%05d.ts'),
+        '-var_stream_map', streams,
+        os.path.join(out_dir, 'v%v', 'index.m3u8'),
+    ]
+
+
+def hls_command(video_path, out_dir, rungs, has_audio, preset='veryfast', segment_seconds=6, threads=0):
+    """One ffmpeg run that decodes once and encodes every rung into an HLS ladder"""
+    cmd = [FFMPEG, '-v', 'error', '-nostdin', '-y', '-i', video_path, '-filter_complex', _scale_filter(rungs)]
+    for i, (_, video_kbps, audio_kbps) in enumerate(rungs):
+        cmd += ['-map', f'[v{i}out]', f'-c:v:{i}', 'libx264'] + _video_rate_args(i, video_kbps)
+        if has_audio:
+            cmd += ['-map', '0:a:0', f'-c:a:{i}', 'aac', f'-b:a:{i}', f'{audio_kbps}k']
+    cmd += _encoder_args(preset, segment_seconds, threads)
+    cmd += ['-ac', '2'] + _hls_output_args(out_dir, rungs, has_audio, segment_seconds)
+    return cmd
+
+
+def _run(cmd):
+    result = subprocess.run(cmd, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+    if result.returncode != 0:
+        message = result.stderr.decode('utf-8', 'replace').strip()[-500:]
+        raise RuntimeError(f'ffmpeg exited with {result.returncode}: {message}')
+
+
+def _publish(work_dir, out_dir, playlist_path):
+    try:
+        os.rename(work_dir, out_dir)
+    except OSError:
+        if not os.path.exists(playlist_path):
+            raise
+        # The same content was transcoded concurrently; keep that copy
+
+
+def transcode_hls(video_path, playlist_path, source_height, has_audio, heights=(1080, 720, 480, 360),
+                  preset='veryfast', segment_seconds=6, threads=0):
+    """Transcode a video into an HLS ladder whose master playlist ends up at playlist_path.
+
+    Uses libx264 on the CPU only. The ladder is written to a scratch
+    directory and renamed into place when complete, so a crash never
+    leaves a half-written playlist. Returns the list of rung heights.
+    """
+    out_dir = os.path.dirname(playlist_path)
+    work_dir = f'{out_dir}.{uuid.uuid4().hex}.tmp'
+    rungs = select_ladder(source_height, heights)
+    cmd = hls_command(video_path, work_dir, rungs, has_audio, preset, segment_seconds, threads)
+    for i in range(len(rungs)):
+        os.makedirs(os.path.join(work_dir, f'v{i}'), exist_ok=True)
+
+    try:
+        _run(cmd)
+        _publish(work_dir, out_dir, playlist_path)
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+    return [height for height, _, _ in rungs]
+
+
+def remux_faststart(video_path, output_path, extension):
+    """Rewrite an MP4/MOV with its moov box first, by stream copy (nothing is re-encoded)"""
+    _run([
+        FFMPEG, '-v', 'error', '-nostdin', '-y', '-i', video_path,
+        '-map', '0', '-c', 'copy', '-map_metadata', '0', '-movflags', '+faststart',
+        '-f', 'mov' if extension == 'mov' else 'mp4', output_path,
+    ])
+
+
+def _split(video_path, work_dir, chunk_seconds):
+    """Cut the video stream at keyframes into roughly chunk_seconds pieces, by stream copy"""
+    source_dir = os.path.join(work_dir, 'source')
+    shutil.rmtree(source_dir, ignore_errors=True)
+    os.makedirs(source_dir)
+    chunk_list = os.path.join(source_dir, 'chunks.csv')
+    _run([
+        FFMPEG, '-v', 'error', '-nostdin', '-y', '-i', video_path,
+        '-map', '0:v:0', '-an', '-sn', '-dn', '-c', 'copy',
+        '-f', 'segment', '-segment_time', str(chunk_seconds), '-reset_timestamps', '1',
+        '-segment_list', chunk_list, '-segment_list_type', 'csv',
+        os.path.join(source_dir, 'chunk_%05d.mkv'),
+    ])
+    with open(chunk_list) as f:
+        return [line.split(',', 1)[0] for line in f if line.strip()]
+
+
+def _encode_chunk(chunk_path, outputs, rungs, preset, segment_seconds, threads):
+    """Encode one source chunk into every rung; each output appears only once it is complete"""
+    cmd = [FFMPEG, '-v', 'error', '-nostdin', '-y', '-i', chunk_path, '-filter_complex', _scale_filter(rungs)]
+    for i, ((_, video_kbps, _), output) in enumerate(zip(rungs, outputs)):
+        cmd += ['-map', f'[v{i}out]', '-c:v', 'libx264'] + _video_rate_args(0, video_kbps)
+        cmd += _encoder_args(preset, segment_seconds, threads) + ['-f', 'matroska', f'{output}.tmp']
+    _run(cmd)
+    for output in outputs:
+        os.rename(f'{output}.tmp', output)
+
+
+def _encode_audio(video_path, outputs, rungs):
+    """Audio is cheap to encode, so it is done in one piece rather than per chunk"""
+    cmd = [FFMPEG, '-v', 'error', '-nostdin', '-y', '-i', video_path]
+    for (_, _, audio_kbps), output in zip(rungs, outputs):
+        cmd += ['-map', '0:a:0', '-vn', '-c:a', 'aac', '-b:a', f'{audio_kbps}k', '-ac', '2',
+                '-f', 'mp4', f'{output}.tmp']
+    _run(cmd)
+    for output in outputs:
+        os.rename(f'{output}.tmp', output)
+
+
+def transcode_hls_segmented(video_path, playlist_path, source_height, has_audio, heights=(1080, 720, 480, 360),
+                            preset='veryfast', segment_seconds=6, threads=0, workers=None, chunk_seconds=60):
+    """Like transcode_hls, but with the encode spread over `workers` ffmpeg processes.
+
+    The source is cut at keyframes into chunks of about `chunk_seconds`
+    (stream copy), every chunk is encoded into all rungs in parallel, and
+    the encoded chunks are joined by stream copy into the HLS ladder.
+    Finished chunks are kept in <out>.work/ until the ladder is in place,
+    so a job that crashed or timed out resumes at the first unfinished
+    chunk instead of starting over. Returns the list of rung heights, or
+    None if another job finished the same ladder first.
+    """
+    workers = workers or os.cpu_count() or 1
+    # Whole HLS segments per chunk keeps segment boundaries regular
+    chunk_seconds = math.ceil(chunk_seconds / segment_seconds) * segment_seconds
+    out_dir = os.path.dirname(playlist_path)
+    work_dir = f'{out_dir}.work'
+    os.makedirs(work_dir, exist_ok=True)
+
+    # Identical uploads share a work dir: one job transcodes, the other waits
+    with open(os.path.join(work_dir, 'lock'), 'w') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        if os.path.exists(playlist_path):
+            shutil.rmtree(work_dir, ignore_errors=True)
+            return None
+
+        manifest_path = os.path.join(work_dir, MANIFEST)
+        if os.path.exists(manifest_path):
+            with open(manifest_path) as f:
+                manifest = json.load(f)
+        else:
+            manifest = {
+                'rungs': select_ladder(source_height, heights),
+                'chunks': _split(video_path, work_dir, chunk_seconds),
+            }
+            with open(f'{manifest_path}.tmp', 'w') as f:
+                json.dump(manifest, f)
+            os.replace(f'{manifest_path}.tmp', manifest_path)
+        rungs, chunks = manifest['rungs'], manifest['chunks']
+
+        for i in range(len(rungs)):
+            os.makedirs(os.path.join(work_dir, f'r{i}'), exist_ok=True)
+        encoded = [[os.path.join(work_dir, f'r{i}', chunk) for i in range(len(rungs))] for chunk in chunks]
+        audio = [os.path.join(work_dir, f'r{i}', 'audio.m4a') for i in range(len(rungs))]
+        # Each chunk gets a share of the cores rather than ffmpeg's default of all of them
+        chunk_threads = threads or max(1, (os.cpu_count() or 1) // workers)
+
+        # The pool's threads only wait on ffmpeg; the encoding runs in the ffmpeg processes
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            futures = []
+            if has_audio and not all(os.path.exists(path) for path in audio):
+                futures.append(pool.submit(_encode_audio, video_path, audio, rungs))
+            for chunk, outputs in zip(chunks, encoded):
+                if not all(os.path.exists(path) for path in outputs):
+                    futures.append(pool.submit(
+                        _encode_chunk, os.path.join(work_dir, 'source', chunk), outputs,
+                        rungs, preset, segment_seconds, chunk_threads
+                    ))
+            for future in futures:
+                future.result()
+
+        package_dir = f'{out_dir}.{uuid.uuid4().hex}.tmp'
+        cmd = [FFMPEG, '-v', 'error', '-nostdin', '-y']
+        for i in range(len(rungs)):
+            concat_list = os.path.join(work_dir, f'r{i}', 'concat.txt')
+            with open(concat_list, 'w') as f:
+                f.writelines(f"file '{chunk}'\n" for chunk in chunks)
+            cmd += ['-f', 'concat', '-safe', '0', '-i', concat_list]
+        if has_audio:
+            for path in audio:
+                cmd += ['-i', path]
+        for i, (_, video_kbps, audio_kbps) in enumerate(rungs):
+            cmd += ['-map', f'{i}:v:0']
+            if has_audio:
+                cmd += ['-map', f'{len(rungs) + i}:a:0', f'-b:a:{i}', f'{audio_kbps}k']
+            # Stream copy knows no bitrate; these feed the master playlist's BANDWIDTH
+            cmd += [f'-b:v:{i}', f'{video_kbps}k']
+        cmd += ['-c', 'copy'] + _hls_output_args(package_dir, rungs, has_audio, segment_seconds)
+        for i in range(len(rungs)):
+            os.makedirs(os.path.join(package_dir, f'v{i}'), exist_ok=True)
+        try:
+            _run(cmd)
+            _publish(package_dir, out_dir, playlist_path)
+        finally:
+            shutil.rmtree(package_dir, ignore_errors=True)
+        shutil.rmtree(work_dir, ignore_errors=True)
+    return [height for height, _, _ in rungs]
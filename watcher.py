@@ -0,0 +1,281 @@
+"""Watch-folder ingestion daemon.
+
+Files dropped into a watched directory (e.g. a mounted network share)
+are ingested like uploads, without going through HTTP:
+<root>/<Category name>/.../clip.mp4 lands in that category (created on
+demand), files directly under the root go to WATCH_DEFAULT_CATEGORY.
+
+Directories are watched recursively with inotify. A file is only picked
+up once its size and mtime have stopped changing for
+WATCH_SETTLE_SECONDS, so half-copied files are never ingested. Writes
+made by other hosts on a network filesystem don't raise inotify events,
+so the roots are also rescanned every WATCH_RESCAN_SECONDS (and on
+start-up); without inotify (non-Linux) the rescan is all there is.
+"""
+import argparse
+import ctypes
+import ctypes.util
+import os
+import select
+import struct
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from sqlalchemy.exc import IntegrityError
+
+from app import app, db, Category, allowed_file, create_uploaded_video, title_from_filename, upload_store
+from container import SNIFF_SIZE
+import sqlite_file
+from probe import is_video_header
+from store import ContentRejected, IngestFile
+
+IN_MODIFY = 0x00000002
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ISDIR = 0x40000000
+WATCH_MASK = IN_MODIFY | IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE
+EVENT_HEADER = struct.Struct('iIII')  # wd, mask, cookie, len
+COPY_BUFFER_SIZE = 1024 * 1024
+
+
+class Inotify:
+    """Recursive inotify watch over a set of directories, via libc"""
+
+    def __init__(self):
+        self.libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        self.fd = self.libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), 'inotify_init1 failed')
+        self.watches = {}
+        self.overflowed = False
+
+    def add_tree(self, root):
+        """Watch root and every directory below it"""
+        for directory, subdirectories, _ in os.walk(root):
+            subdirectories[:] = [d for d in subdirectories if not d.startswith('.')]
+            wd = self.libc.inotify_add_watch(self.fd, os.fsencode(directory), WATCH_MASK)
+            if wd < 0:
+                print(f"Cannot watch {directory}: {os.strerror(ctypes.get_errno())}")
+                continue
+            self.watches[wd] = directory
+
+    def read(self, timeout):
+        """Paths of files that changed, waiting up to `timeout` seconds for the first event"""
+        ready, _, _ = select.select([self.fd], [], [], timeout)
+        if not ready:
+            return []
+        data = os.read(self.fd, 64 * 1024)
+        paths = []
+        offset = 0
+        while offset < len(data):
+            wd, mask, _, length = EVENT_HEADER.unpack_from(data, offset)
+            name = os.fsdecode(data[offset + EVENT_HEADER.size:offset + EVENT_HEADER.size + length].rstrip(b'\0'))
+            offset += EVENT_HEADER.size + length
+            if mask & IN_Q_OVERFLOW:
+                self.overflowed = True  # Events were lost: the caller rescans
+                continue
+            if mask & IN_IGNORED:
+                self.watches.pop(wd, None)
+                continue
+            directory = self.watches.get(wd)
+            if directory is None or not name:
+                continue
+            path = os.path.join(directory, name)
+            if mask & IN_ISDIR:
+                if mask & (IN_CREATE | IN_MOVED_TO):
+                    # A directory created or moved in may already hold files
+                    self.add_tree(path)
+                    paths.extend(iter_files(path))
+                continue
+            paths.append(path)
+        return paths
+
+
+class Ledger:
+    """Files already ingested, keyed by path, so restarts and rescans skip them.
+
+    The whole ledger is also kept in memory: rescans check every file in
+    the tree against it.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        with sqlite_file.create(self.path) as conn:
+            conn.execute('''
+                CREATE TABLE IF NOT EXISTS ingested (
+                    path TEXT PRIMARY KEY,
+                    size INTEGER NOT NULL,
+                    mtime_ns INTEGER NOT NULL,
+                    video_id INTEGER,
+                    error TEXT,
+                    ingested_at REAL NOT NULL
+                )
+            ''')
+            self.signatures = {
+                path: (size, mtime_ns) for path, size, mtime_ns in conn.execute('SELECT path, size, mtime_ns FROM ingested')
+            }
+
+    def _connect(self):
+        return sqlite_file.connect(self.path)
+
+    def seen(self, path, signature):
+        return self.signatures.get(path) == signature
+
+    def record(self, path, signature, video_id=None, error=None):
+        self.signatures[path] = signature
+        with self._connect() as conn:
+            conn.execute(
+                'INSERT OR REPLACE INTO ingested (path, size, mtime_ns, video_id, error, ingested_at) '
+                'VALUES (?, ?, ?, ?, ?, ?)',
+                (path, signature[0], signature[1], video_id, error, time.time())
+            )
+
+
+def iter_files(root):
+    for directory, subdirectories, filenames in os.walk(root):
+        subdirectories[:] = [d for d in subdirectories if not d.startswith('.')]
+        for filename in filenames:
+            # Hidden names are in-progress transfers (rsync, scp, Samba)
+            if not filename.startswith('.'):
+                yield os.path.join(directory, filename)
+
+
+def file_signature(path):
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return None
+    return stat.st_size, stat.st_mtime_ns
+
+
+def category_for(root, path):
+    """Category name from the first directory below the watch root"""
+    parts = os.path.relpath(path, root).split(os.sep)
+    return parts[0] if len(parts) > 1 else app.config['WATCH_DEFAULT_CATEGORY']
+
+
+def get_or_create_category(name):
+    category = Category.query.filter_by(name=name).first()
+    if category is None:
+        try:
+            category = Category(name=name)
+            db.session.add(category)
+            db.session.commit()
+        except IntegrityError:
+            # Created concurrently (another ingest thread or the web UI)
+            db.session.rollback()
+            category = Category.query.filter_by(name=name).first()
+    return category
+
+
+def ingest_file(root, path, signature, ledger):
+    """Copy one settled file into the upload store and hand it to the upload pipeline"""
+    extension = path.rsplit('.', 1)[1].lower()
+    # The share is usually another filesystem, so the file is copied (not
+    # renamed) into the store; hashing and the magic-byte check happen on
+    # that same pass
+    ingest = IngestFile(upload_store.temp_path(f'.{extension}'), is_video_header, SNIFF_SIZE)
+    try:
+        with open(path, 'rb') as source:
+            for chunk in iter(lambda: source.read(COPY_BUFFER_SIZE), b''):
+                ingest.write(chunk)
+                if ingest.rejected:
+                    break
+        digest = ingest.finish()
+        with app.app_context():
+            category = get_or_create_category(category_for(root, path))
+            video = create_uploaded_video(ingest.path, extension, title_from_filename(path), category.id, digest)
+        if video is None:
+            ledger.record(path, signature, error='not a readable video')
+        else:
+            ledger.record(path, signature, video_id=video.id)
+            print(f"Ingested {path} as video {video.id}")
+    except ContentRejected as e:
+        print(f"Skipped {path}: {e}")
+        ledger.record(path, signature, error=str(e))
+    except Exception as e:
+        # Not recorded, so the next rescan retries it
+        print(f"Error ingesting {path}: {e}")
+    finally:
+        ingest.close()
+
+
+def run_watcher(roots, settle_seconds, rescan_seconds, workers):
+    roots = [os.path.abspath(root) for root in roots]
+    ledger = Ledger(os.path.join(app.instance_path, 'watch.db'))
+    try:
+        inotify = Inotify()
+        for root in roots:
+            inotify.add_tree(root)
+    except (OSError, AttributeError) as e:
+        print(f"inotify unavailable, polling every {rescan_seconds}s: {e}")
+        inotify = None
+
+    # path -> (signature, time it was last seen changing)
+    pending = {}
+    in_flight = set()
+    lock = threading.Lock()
+    pool = ThreadPoolExecutor(max_workers=workers)
+    next_rescan = 0
+
+    def root_of(path):
+        return next((root for root in roots if path.startswith(root + os.sep)), None)
+
+    def done(path):
+        with lock:
+            in_flight.discard(path)
+
+    print(f"Watching {', '.join(roots)} ({'inotify' if inotify else 'polling'}, {workers} ingest threads)")
+    while True:
+        changed = inotify.read(timeout=1.0) if inotify else []
+        if not inotify:
+            time.sleep(1.0)
+        now = time.monotonic()
+        if now >= next_rescan or (inotify and inotify.overflowed):
+            changed.extend(path for root in roots for path in iter_files(root))
+            next_rescan = now + rescan_seconds
+            if inotify:
+                inotify.overflowed = False
+
+        for path in changed:
+            name = os.path.basename(path)
+            if path in pending or name.startswith('.') or not allowed_file(name):
+                continue
+            signature = file_signature(path)
+            if signature is not None and not ledger.seen(path, signature):
+                pending[path] = (signature, now)
+
+        for path, (signature, since) in list(pending.items()):
+            current = file_signature(path)
+            if current is None:
+                del pending[path]  # Deleted or moved away before it settled
+            elif current != signature:
+                pending[path] = (current, now)
+            elif now - since >= settle_seconds:
+                del pending[path]
+                with lock:
+                    if path in in_flight:
+                        continue
+                    in_flight.add(path)
+                future = pool.submit(ingest_file, root_of(path), path, current, ledger)
+                future.add_done_callback(lambda _, path=path: done(path))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Video Organizer watch-folder ingestion daemon')
+    parser.add_argument('folders', nargs='*', help='Directories to watch (default: WATCH_FOLDERS)')
+    parser.add_argument('--settle', type=float, default=app.config['WATCH_SETTLE_SECONDS'],
+                        help='Seconds a file must stop changing before it is ingested')
+    parser.add_argument('--rescan', type=float, default=app.config['WATCH_RESCAN_SECONDS'],
+                        help='Seconds between full rescans of the watched folders')
+    parser.add_argument('--workers', type=int, default=app.config['WATCH_WORKERS'], help='Files ingested concurrently')
+    args = parser.parse_args()
+
+    folders = args.folders or app.config['WATCH_FOLDERS']
+    if not folders:
+        parser.error('no folders given and WATCH_FOLDERS is empty')
+    run_watcher(folders, args.settle, args.rescan, args.workers)
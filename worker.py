@@ -0,0 +1,301 @@
+import argparse
+import json
+import os
+import threading
+import time
+import traceback
+
+from app import app, db, Video, YoutubeImport, job_queue, thumbnail_store, upload_store
+from container import needs_faststart
+from sprites import generate_sprite_sheet
+from playlist_import import run_import
+from probe import probe_video
+from thumbnails import ThumbnailEngine, probe_and_generate_thumbnail
+from store import ContentStore
+from transcode import hls_key, remove_hls, remux_faststart, transcode_hls, transcode_hls_segmented
+
+# Created in run_worker() so importing this module never forks a pool
+thumbnail_engine = None
+
+
+def process_thumbnail_job(payload):
+    """Generate the thumbnail for an uploaded video and mark it ready"""
+    video = db.session.get(Video, payload['video_id'])
+    if video is None:
+        return  # Deleted before the worker got to it
+
+    video_path = upload_store.path(video.video_path)
+    result = thumbnail_engine.run(
+        probe_and_generate_thumbnail,
+        video_path,
+        thumbnail_store,
+        seek_mode=app.config['THUMBNAIL_SEEK_MODE'],
+        seek_seconds=app.config['THUMBNAIL_SEEK_SECONDS'],
+        widths=app.config['THUMBNAIL_WIDTHS'],
+        encoders=app.config['THUMBNAIL_ENCODERS'],
+        samples=app.config['THUMBNAIL_SAMPLES'],
+        budget_seconds=app.config['THUMBNAIL_BUDGET_SECONDS']
+    )
+    if not result:
+        raise RuntimeError(f'Could not generate thumbnail for {video.video_path}')
+
+    video.set_metadata(result['metadata'])
+    video.set_thumbnails(result['variants'])
+    video.status = 'ready'
+    db.session.commit()
+    # Scrub previews and streaming renditions are optional, so they retry
+    # independently of the thumbnail
+    job_queue.enqueue('sprite', {'video_id': video.id})
+    if app.config['TRANSCODE_ENABLED']:
+        job_queue.enqueue('transcode', {'video_id': video.id})
+
+
+def process_sprite_job(payload):
+    """Build the hover-scrub sprite sheet and WebVTT index for an uploaded video"""
+    video = db.session.get(Video, payload['video_id'])
+    if video is None:
+        return
+
+    video_path = upload_store.path(video.video_path)
+    result = thumbnail_engine.run(
+        generate_sprite_sheet,
+        video_path,
+        thumbnail_store,
+        interval=app.config['SPRITE_INTERVAL'],
+        tile_width=app.config['SPRITE_TILE_WIDTH'],
+        columns=app.config['SPRITE_COLUMNS'],
+        max_frames=app.config['SPRITE_MAX_FRAMES'],
+        duration=video.duration,
+        source_size=(video.width, video.height)
+    )
+    if not result:
+        raise RuntimeError(f'Could not generate sprite sheet for {video.video_path}')
+
+    video.sprite_path, video.sprite_vtt_path = result
+    db.session.commit()
+
+
+def process_transcode_job(payload):
+    """Build the HLS ladder for an uploaded video next to its file in the upload store"""
+    video = db.session.get(Video, payload['video_id'])
+    if video is None:
+        return
+
+    playlist_key = hls_key(video.video_path)
+    # Identical uploads share one file, and so one ladder
+    if not os.path.exists(upload_store.path(playlist_key)):
+        options = dict(
+            source_height=video.height,
+            has_audio=bool(video.audio_codec),
+            heights=app.config['HLS_HEIGHTS'],
+            preset=app.config['TRANSCODE_PRESET'],
+            segment_seconds=app.config['HLS_SEGMENT_SECONDS'],
+            threads=app.config['TRANSCODE_THREADS']
+        )
+        workers = app.config['TRANSCODE_SEGMENT_WORKERS']
+        chunk_seconds = app.config['TRANSCODE_CHUNK_SECONDS']
+        # ffmpeg is its own process, so this runs outside the decode pool
+        if workers > 1 and (video.duration or 0) > 2 * chunk_seconds:
+            transcode_hls_segmented(
+                upload_store.path(video.video_path), upload_store.path(playlist_key),
+                workers=workers, chunk_seconds=chunk_seconds, **options
+            )
+        else:
+            transcode_hls(upload_store.path(video.video_path), upload_store.path(playlist_key), **options)
+    video.hls_path = playlist_key
+    db.session.commit()
+
+
+def process_faststart_job(payload):
+    """Remux a stored MP4/MOV with its moov box first and move every video using it to the new key.
+
+    For a new upload (`queue_thumbnails`) the thumbnail jobs are queued
+    once the videos have moved, so they never read the file being replaced.
+    """
+    old_key = payload['video_key']
+    # Set if an earlier attempt swapped the file but died before the rows were updated
+    new_key = upload_store.aliased(ContentStore.digest_of(old_key))
+    if new_key is None:
+        old_path = upload_store.path(old_key)
+        if not os.path.exists(old_path) or not needs_faststart(old_path):
+            queue_thumbnails(payload)
+            return
+        extension = old_key.rsplit('.', 1)[1]
+        scratch_path = upload_store.temp_path(f'.{extension}')
+        try:
+            remux_faststart(old_path, scratch_path, extension)
+            new_key = upload_store.replace(old_key, scratch_path, extension)
+        finally:
+            if os.path.exists(scratch_path):
+                os.remove(scratch_path)
+
+    # The ladder is named after the upload, so it moves with it
+    old_hls = os.path.dirname(upload_store.path(hls_key(old_key)))
+    new_hls = os.path.dirname(upload_store.path(hls_key(new_key)))
+    if os.path.exists(old_hls) and not os.path.exists(new_hls):
+        os.rename(old_hls, new_hls)
+    remove_hls(app.config['UPLOAD_FOLDER'], old_key)
+    has_hls = os.path.exists(upload_store.path(hls_key(new_key)))
+    for video in Video.query.filter_by(video_path=old_key):
+        video.video_path = new_key
+        video.hls_path = hls_key(new_key) if has_hls else None
+    db.session.commit()
+    queue_thumbnails(payload)
+
+
+def queue_thumbnails(payload):
+    """Queue the thumbnails a faststart job held back; also its dead-letter callback, so they still come"""
+    if not payload.get('queue_thumbnails'):
+        return
+    key = upload_store.aliased(ContentStore.digest_of(payload['video_key'])) or payload['video_key']
+    for video in Video.query.filter(Video.video_path.in_((key, payload['video_key'])), Video.status == 'pending'):
+        job_queue.enqueue('thumbnail', {'video_id': video.id})
+
+
+def process_probe_job(payload):
+    """Fill in technical metadata for a video uploaded before probing existed"""
+    video = db.session.get(Video, payload['video_id'])
+    if video is None:
+        return
+
+    video.set_metadata(thumbnail_engine.run(probe_video, upload_store.path(video.video_path)))
+    db.session.commit()
+
+
+def mark_video_failed(payload):
+    """Called once a thumbnail job has been dead-lettered"""
+    video = db.session.get(Video, payload['video_id'])
+    if video is not None:
+        video.status = 'failed'
+        db.session.commit()
+
+
+def process_youtube_import_job(payload):
+    """Import a YouTube playlist or channel; a retried job resumes at the first unfinished video"""
+    run_import(payload['import_id'])
+
+
+def mark_import_failed(payload):
+    youtube_import = db.session.get(YoutubeImport, payload['import_id'])
+    if youtube_import is not None:
+        youtube_import.status = 'failed'
+        db.session.commit()
+
+
+# kind -> (handler, dead-letter callback)
+JOB_HANDLERS = {
+    'thumbnail': (process_thumbnail_job, mark_video_failed),
+    'sprite': (process_sprite_job, lambda payload: None),
+    'probe': (process_probe_job, lambda payload: None),
+    'transcode': (process_transcode_job, lambda payload: None),
+    'faststart': (process_faststart_job, queue_thumbnails),
+    'youtube_import': (process_youtube_import_job, mark_import_failed),
+}
+# Long jobs with their own thread pool, so they never hold up thumbnails.
+# A faststart remux is a stream copy and holds up a new upload's
+# thumbnail, so it runs with the decode jobs rather than behind a transcode
+TRANSCODE_KINDS = ['transcode']
+# Network-bound, long and light on CPU: neither behind a transcode nor
+# taking a decode slot
+IMPORT_KINDS = ['youtube_import']
+
+
+def heartbeat(job_id, stop):
+    # Keeps jobs that outlast the queue's lock timeout (transcodes) from
+    # being reclaimed as abandoned by another thread
+    while not stop.wait(job_queue.lock_timeout / 3):
+        job_queue.touch(job_id)
+
+
+def run_job(job):
+    handler, on_dead = JOB_HANDLERS[job['kind']]
+    stop = threading.Event()
+    threading.Thread(target=heartbeat, args=(job['id'], stop), daemon=True).start()
+    with app.app_context():
+        try:
+            handler(job['payload'])
+        except Exception as e:
+            db.session.rollback()
+            print(f"Job {job['id']} ({job['kind']}) failed on attempt {job['attempts']}: {e}")
+            traceback.print_exc()
+            if job_queue.fail(job['id'], e):
+                print(f"Job {job['id']} dead-lettered")
+                on_dead(job['payload'])
+            return
+        finally:
+            stop.set()
+    job_queue.complete(job['id'])
+
+
+def job_loop(poll_interval, once, kinds):
+    while True:
+        job = job_queue.claim(kinds)
+        if job is None:
+            # Jobs still running elsewhere may queue follow-ups (a finished
+            # thumbnail queues its transcode), so "drained" means none are
+            if once and not job_queue.counts().get('running'):
+                return
+            time.sleep(poll_interval)
+            continue
+        run_job(job)
+
+
+def write_metrics():
+    metrics_file = app.config['THUMBNAIL_METRICS_FILE']
+    tmp_file = f'{metrics_file}.{os.getpid()}.tmp'
+    with open(tmp_file, 'w') as f:
+        json.dump(thumbnail_engine.metrics(), f)
+    os.replace(tmp_file, metrics_file)
+
+
+def run_worker(poll_interval=1.0, once=False):
+    global thumbnail_engine
+    thumbnail_engine = ThumbnailEngine(
+        workers=app.config['THUMBNAIL_WORKERS'],
+        max_in_flight=app.config['THUMBNAIL_MAX_IN_FLIGHT'],
+        max_queued=app.config['THUMBNAIL_MAX_QUEUED']
+    )
+    # One claiming thread per decode slot plus the wait queue, so the
+    # engine stays saturated without ever having to reject a job
+    thread_count = thumbnail_engine.max_in_flight + thumbnail_engine.max_queued
+    decode_kinds = [kind for kind in JOB_HANDLERS if kind not in TRANSCODE_KINDS + IMPORT_KINDS]
+    threads = [
+        threading.Thread(target=job_loop, args=(poll_interval, once, decode_kinds), daemon=True)
+        for _ in range(thread_count)
+    ]
+    # Each transcode thread drives one ffmpeg at a time
+    transcode_count = app.config['TRANSCODE_CONCURRENCY']
+    threads += [
+        threading.Thread(target=job_loop, args=(poll_interval, once, TRANSCODE_KINDS), daemon=True)
+        for _ in range(transcode_count)
+    ]
+    import_count = app.config['YOUTUBE_IMPORT_JOBS']
+    threads += [
+        threading.Thread(target=job_loop, args=(poll_interval, once, IMPORT_KINDS), daemon=True)
+        for _ in range(import_count)
+    ]
+    for thread in threads:
+        thread.start()
+    print(f'Worker started: {thumbnail_engine.workers} decode processes, {thread_count} job threads, '
+          f'{transcode_count} transcode threads, {import_count} import threads')
+
+    try:
+        while any(thread.is_alive() for thread in threads):
+            write_metrics()
+            time.sleep(poll_interval)
+        write_metrics()
+    finally:
+        thumbnail_engine.shutdown()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Video Organizer background worker')
+    parser.add_argument('--poll-interval', type=float, default=1.0, help='Seconds to sleep when the queue is empty')
+    parser.add_argument('--once', action='store_true', help='Exit once the queue is drained')
+    parser.add_argument('--requeue-dead', action='store_true', help='Retry all dead-lettered jobs and exit')
+    args = parser.parse_args()
+
+    if args.requeue_dead:
+        print(f'Requeued {job_queue.requeue_dead()} dead-lettered jobs')
+    else:
+        run_worker(args.poll_interval, args.once)
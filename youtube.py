@@ -0,0 +1,172 @@
+import json
+import re
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+import http_client
+import sqlite_file
+
+YOUTUBE_IMAGE_HOST = 'https://img.youtube.com'
+YOUTUBE_OEMBED_URL = 'https://www.youtube.com/oembed'
+# Largest first; maxres and sd don't exist for every video
+THUMBNAIL_NAMES = ['maxresdefault.jpg', 'sddefault.jpg', 'hqdefault.jpg']
+# (connect, read) seconds
+PROBE_TIMEOUT = (3.05, 5)
+DOWNLOAD_TIMEOUT = (3.05, 15)
+YOUTUBE_ID_PATTERN = re.compile(r'(?:https?://)?(?:www\.)?(?:youtube\.com/(?:[^/\n]+/\S+/|(?:v|e(?:mbed)?|vi|watch|shorts)/|.*[?&]v=)|youtu\.be/)([a-zA-Z0-9_-]{11})')
+
+
+def extract_video_id(youtube_url):
+    """The 11-character video ID of any watch/short/embed/youtu.be URL, or None"""
+    video_id_match = YOUTUBE_ID_PATTERN.search(youtube_url or '')
+    return video_id_match.group(1) if video_id_match else None
+
+
+_probe_pool = ThreadPoolExecutor(max_workers=8, thread_name_prefix='thumbnail-probe')
+
+
+def thumbnail_urls(video_id, image_host=YOUTUBE_IMAGE_HOST):
+    return [f'{image_host}/vi/{video_id}/{name}' for name in THUMBNAIL_NAMES]
+
+
+def probe(url, http=None, timeout=PROBE_TIMEOUT):
+    """True if url exists: a HEAD, or a one-byte range GET for servers that refuse HEAD.
+
+    Raises HTTPError when the host is failing (5xx, 429), which says
+    nothing about whether the URL exists.
+    """
+    http = http or http_client.client
+    response = http.head(url, timeout=timeout)
+    if response.status_code in (405, 501):
+        response = http.get(url, headers={'Range': 'bytes=0-0'}, timeout=timeout, stream=True)
+        response.close()
+    if response.status_code in http_client.FAILURE_STATUSES:
+        response.raise_for_status()
+    return response.status_code in (200, 206)
+
+
+def first_available(urls, http=None, timeout=PROBE_TIMEOUT, executor=None):
+    """The first of `urls` (best first) that exists, or None.
+
+    Every candidate is probed at once, so a missing maxres costs no extra
+    round trip; the answer is ready as soon as the best existing URL
+    (and those ahead of it) have replied. Bulk callers pass an `executor`
+    sized for their own concurrency instead of the shared 8 threads.
+
+    If nothing was found but some probe failed, its error is raised:
+    that is "couldn't tell", not "none exists".
+    """
+    futures = [(executor or _probe_pool).submit(probe, url, http, timeout) for url in urls]
+    error = None
+    for url, future in zip(urls, futures):
+        try:
+            if future.result():
+                return url
+        except requests.RequestException as e:
+            print(f'Error probing {url}: {e}')
+            error = error or e
+    if error is not None:
+        raise error
+    return None
+
+
+def fetch_first_available(urls, http=None, executor=None):
+    """Content of the best of `urls` that exists, downloading only that one; None if none does"""
+    url = first_available(urls, http, executor=executor)
+    if url is None:
+        return None
+    response = (http or http_client.client).get(url, timeout=DOWNLOAD_TIMEOUT)
+    response.raise_for_status()
+    return response.content
+
+
+def oembed_info(video_id, oembed_url=YOUTUBE_OEMBED_URL, image_host=YOUTUBE_IMAGE_HOST, timeout=5):
+    """Title and direct thumbnail URLs from one oEmbed request, without yt-dlp.
+
+    Returns None when the endpoint doesn't describe the video (private,
+    removed or not embeddable). oEmbed has no duration, so it is None.
+    """
+    response = http_client.client.get(
+        oembed_url,
+        params={'url': f'https://www.youtube.com/watch?v={video_id}', 'format': 'json'},
+        timeout=timeout
+    )
+    if response.status_code != 200:
+        return None
+    title = response.json().get('title')
+    if not title:
+        return None
+    return {'title': title, 'thumbnails': thumbnail_urls(video_id, image_host), 'duration': None}
+
+
+class VideoInfoCache:
+    """yt-dlp results (title, thumbnail URLs, duration) keyed by video ID.
+
+    Two tiers: an LRU dict in this process in front of a SQLite table
+    that every process (gunicorn workers, the job worker) shares, so a
+    video looked up anywhere is never extracted again within `ttl`.
+    """
+
+    def __init__(self, path, ttl=7 * 86400, max_entries=1024):
+        self.path = path
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.entries = OrderedDict()  # video_id -> (fetched_at, info), least recently used first
+        self.lock = threading.Lock()
+        with sqlite_file.create(self.path) as conn:
+            conn.execute('''
+                CREATE TABLE IF NOT EXISTS video_info (
+                    video_id TEXT PRIMARY KEY,
+                    title TEXT,
+                    thumbnails TEXT NOT NULL,
+                    duration REAL,
+                    fetched_at REAL NOT NULL
+                )
+            ''')
+
+    def _connect(self):
+        return sqlite_file.connect(self.path)
+
+    def get(self, video_id):
+        """{'title', 'thumbnails', 'duration'} if cached and fresh, else None"""
+        now = time.time()
+        with self.lock:
+            entry = self.entries.get(video_id)
+            if entry is not None:
+                if now - entry[0] < self.ttl:
+                    self.entries.move_to_end(video_id)
+                    return entry[1]
+                del self.entries[video_id]
+
+        with self._connect() as conn:
+            row = conn.execute(
+                'SELECT title, thumbnails, duration, fetched_at FROM video_info WHERE video_id = ? AND fetched_at > ?',
+                (video_id, now - self.ttl)
+            ).fetchone()
+        if row is None:
+            return None
+        info = {'title': row[0], 'thumbnails': json.loads(row[1]), 'duration': row[2]}
+        self._remember(video_id, row[3], info)
+        return info
+
+    def put(self, video_id, info):
+        fetched_at = time.time()
+        with self._connect() as conn:
+            conn.execute(
+                'INSERT OR REPLACE INTO video_info (video_id, title, thumbnails, duration, fetched_at) '
+                'VALUES (?, ?, ?, ?, ?)',
+                (video_id, info.get('title'), json.dumps(info.get('thumbnails') or []), info.get('duration'), fetched_at)
+            )
+        self._remember(video_id, fetched_at, info)
+
+    def _remember(self, video_id, fetched_at, info):
+        with self.lock:
+            self.entries[video_id] = (fetched_at, info)
+            self.entries.move_to_end(video_id)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+